@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Requests/sec and p50/p99 latency of every route of `create_app`.
+
+Seeds the database up to `--rows` actors and movies, then fires `--requests`
+requests at each route from `--concurrency` threads, in-process through the
+flask test client by default, or over HTTP at a running server with `--url`:
+
+    python benchmarks/bench_api.py --rows 100000 --output api.json
+    python benchmarks/bench_api.py --rows 100000 --compare api.json
+
+A server started by hand needs the same settings the benchmark uses:
+`AUTH0_DOMAIN=bench.local API_AUDIENCE=bench JWKS_FILE=<--jwks-file> DATABASE=<--database>`.
+"""
+import argparse
+import http.client
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import support
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--database', default='sqlite:////tmp/bench_api.sqlite3')
+parser.add_argument('--jwks-file', default=None)
+parser.add_argument('--rows', type=int, default=10_000, help='actors and movies to seed, e.g. 10000 to 1000000')
+parser.add_argument('--requests', type=int, default=1000, help='requests per route')
+parser.add_argument('--concurrency', type=int, default=1)
+parser.add_argument('--url', help='base url of a running server, instead of the in-process test client')
+parser.add_argument('--output', help='file to save results to, as json')
+parser.add_argument('--compare', help='results file of an earlier run to compare req/s against')
+args = parser.parse_args()
+
+issuer = support.configure(args.database, args.jwks_file)
+
+from src.app import create_app  # noqa: E402
+from src.models import db, Actor, Movie  # noqa: E402
+
+
+class TestClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, headers, body=None):
+        res = self.client.open(path, method=method, headers=headers, data=body)
+        return res.status_code, res.get_data()
+
+
+class HTTPClient:
+    """One keep-alive connection per thread"""
+
+    def __init__(self, url):
+        self.url = urlsplit(url)
+        self.local = threading.local()
+
+    def request(self, method, path, headers, body=None):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = http.client.HTTPConnection(self.url.netloc, timeout=60)
+        connection.request(method, f'{self.url.path.rstrip("/")}{path}', body=body, headers=headers)
+        res = connection.getresponse()
+        return res.status, res.read()
+
+
+def take(created):
+    """Pops an id of `created`. Once failed or throttled POSTs leave it empty, 0, which no row
+    has, so the DELETE gets a 404 and is counted as an error instead of stopping the run
+    """
+    try:
+        return created.pop()
+    except IndexError:
+        return 0
+
+
+def routes(model, key, ids, created):
+    """(name, method, path factory, body factory) of each route of a resource.
+    `created` collects ids from the POST route, which the DELETE route then uses up
+    """
+    new = Actor.example_in() if model is Actor else Movie.example_in()
+    patch = {'name': 'Patched'} if model is Actor else {'title': 'Patched'}
+    middle = ids[len(ids) // 2]
+    return [
+        (f'GET /{key}', 'GET', lambda: f'/{key}', None),
+        (f'GET /{key}?sort&after', 'GET', lambda: f'/{key}?sort=-id&after={middle}&limit=50', None),
+        (f'GET /{key}?fields', 'GET', lambda: f'/{key}?fields=id&limit=1000', None),
+        (f'GET /{key}/<pk>', 'GET', lambda: f'/{key}/{random.choice(ids)}', None),
+        # seeded names and titles end with a number, a random one matches a few rows
+        (f'GET /search?type={key[:-1]}', 'GET', lambda: f'/search?q={random.choice(ids)}&type={key[:-1]}', None),
+        (f'POST /{key}', 'POST', lambda: f'/{key}', lambda: new),
+        (f'PATCH /{key}/<pk>', 'PATCH', lambda: f'/{key}/{random.choice(ids)}', lambda: patch),
+        (f'DELETE /{key}/<pk>', 'DELETE', lambda: f'/{key}/{take(created)}', None),
+    ]
+
+
+def run(client, method, path, body, token, count, concurrency, on_response=None):
+    headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    def worker(n):
+        nonlocal errors
+        for _ in range(n):
+            data = json.dumps(body()) if body else None
+            start = time.perf_counter()
+            status, content = client.request(method, path(), headers, data)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if status >= 400:
+                    errors += 1
+                elif on_response:
+                    on_response(content)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        share, rest = divmod(count, concurrency)
+        list(pool.map(worker, [share + (i < rest) for i in range(concurrency)]))
+    wall = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'requests': count,
+        'errors': errors,
+        'rps': count / wall,
+        'p50_ms': support.percentile(latencies, 0.5) * 1000,
+        'p99_ms': support.percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        for model in (Actor, Movie):
+            print(f'{model.__tablename__}: {support.seed(db, model, args.rows)} rows')
+        ids = {model: [pk for pk, in db.session.query(model.id).limit(10_000)] for model in (Actor, Movie)}
+        db.session.close()
+    client = HTTPClient(args.url) if args.url else TestClient(app)
+    token = issuer.token()
+    results = {}
+    for model, key in ((Actor, 'actors'), (Movie, 'movies')):
+        created = []
+        def collect(content, key=key[:-1]):
+            created.append(json.loads(content)[key]['id'])
+        for name, method, path, body in routes(model, key, ids[model], created):
+            run(client, method, path, body, token, min(50, args.requests), 1, collect if method == 'POST' else None)
+            result = run(client, method, path, body, token, args.requests, args.concurrency,
+                         collect if method == 'POST' else None)
+            results[name] = result
+            print(f'{name:32} {result["rps"]:>10,.0f} req/s  p50 {result["p50_ms"]:>8.2f}ms  '
+                  f'p99 {result["p99_ms"]:>8.2f}ms  errors {result["errors"]}')
+    settings = {k: v for k, v in vars(args).items() if k not in ('output', 'compare')}
+    if args.output:
+        support.save_results(args.output, 'api', settings, results)
+    if args.compare:
+        support.compare(args.compare, results, 'rps')
+
+
+if __name__ == '__main__':
+    main()
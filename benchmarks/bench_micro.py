@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks of the hot paths of a request, without HTTP or a database.
+
+    python benchmarks/bench_micro.py --output micro.json
+    python benchmarks/bench_micro.py --compare micro.json
+"""
+import argparse
+import timeit
+
+import support
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--page', type=int, default=1000, help='rows per serialized list')
+parser.add_argument('--seconds', type=float, default=1, help='rough time spent on each benchmark')
+parser.add_argument('--output', help='file to save results to, as json')
+parser.add_argument('--compare', help='results file of an earlier run to compare ops/s against')
+args = parser.parse_args()
+
+issuer = support.configure('sqlite://')
+
+from flask import json  # noqa: E402
+
+from src import encoding  # noqa: E402
+from src.compression import COMPRESSORS, compress  # noqa: E402
+from src.auth import verify_decode_jwt, token_cache  # noqa: E402
+from src.models import Actor  # noqa: E402
+from src.ratelimit import RateLimiter, parse_budget  # noqa: E402
+
+
+def measure(function):
+    """Calls per second of `function`, timed over about `--seconds`"""
+    number, _ = timeit.Timer(function).autorange()
+    number = max(1, int(number * args.seconds / 0.2))
+    best = min(timeit.Timer(function).repeat(repeat=3, number=number))
+    return number / best
+
+
+def benchmarks():
+    token = issuer.token()
+    verify_decode_jwt(token)  # loads the JWKS
+    token_cache.set(token, verify_decode_jwt(token))
+    actor = Actor(name='Actor', age=30, gender=1)
+    actor.id = 1
+    actors = []
+    for i in range(args.page):
+        a = Actor(name=f'Actor {i}', age=20 + i % 50, gender=i % 2)
+        a.id = i
+        actors.append(a)
+    fields = Actor.json_fields
+    rows = [(a.id, a.name, a.age, a.gender, 1) for a in actors]
+    yield 'verify_decode_jwt', lambda: verify_decode_jwt(token)
+    yield 'token_cache.get', lambda: token_cache.get(token)
+    # a budget that's never used up, so every check takes a token
+    limiter = RateLimiter(default=parse_budget(f'{10 ** 12}/1'))
+    yield 'RateLimiter.check', lambda: limiter.check('get_actors', 'auth0|bench')
+    yield 'Actor.format', actor.format
+    yield 'Actor.format_row', lambda: Actor.format_row(rows[0], fields)
+    yield f'list of {args.page}: format() + flask json', lambda: json.dumps({'actors': [a.format() for a in actors]})
+    for name, dumps in encoding.ENCODERS.items():
+        yield (f'list of {args.page}: format_row() + {name}',
+               lambda dumps=dumps: dumps({'actors': [Actor.format_row(r, fields) for r in rows]}))
+    body = encoding.dumps({'actors': [Actor.format_row(r, fields) for r in rows]})
+    for name in COMPRESSORS:
+        yield f'list of {args.page}: compress {name}', lambda name=name: compress(body, name)
+
+
+def main():
+    results = {}
+    for name, function in benchmarks():
+        ops = measure(function)
+        results[name] = {'ops': ops, 'us': 1e6 / ops}
+        print(f'{name:45} {ops:>14,.0f} ops/s {1e6 / ops:>12.2f}us')
+    if args.output:
+        settings = {k: v for k, v in vars(args).items() if k not in ('output', 'compare')}
+        support.save_results(args.output, 'micro', settings, results)
+    if args.compare:
+        support.compare(args.compare, results, 'ops')
+
+
+if __name__ == '__main__':
+    main()
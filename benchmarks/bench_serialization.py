@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Rows/sec of list endpoint serialization.
+
+Compares the ORM path (hydrate objects, `format()` each of them, encode with
+flask's json) against plain column rows, `format_row()` and each available
+fast encoder. Every path walks the whole table page by page, the same way
+`GET /actors` and `GET /movies` do.
+
+    python benchmarks/bench_serialization.py --rows 100000 --page 1000
+"""
+import argparse
+import time
+
+import support
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--database', default='sqlite:////tmp/bench_serialization.sqlite3')
+parser.add_argument('--rows', type=int, default=100_000)
+parser.add_argument('--page', type=int, default=1000)
+args = parser.parse_args()
+
+support.configure(args.database)
+
+from flask import json  # noqa: E402
+
+from src import encoding  # noqa: E402
+from src.app import create_app  # noqa: E402
+from src.models import db, Actor, Movie  # noqa: E402
+
+
+def walk(fetch, page):
+    """Calls `fetch(after, page)` until the table is exhausted, returns number of rows"""
+    after, total = 0, 0
+    while True:
+        count, after = fetch(after, page)
+        total += count
+        if count < page:
+            return total
+
+
+def orm_path(model, key):
+    def fetch(after, page):
+        items = model.query.filter(model.id > after).order_by(model.id).limit(page).all()
+        body = json.dumps({'success': True, key: [i.format() for i in items]})
+        assert body
+        last = items[-1].id if items else after
+        db.session.expunge_all()
+        return len(items), last
+    return fetch
+
+
+def rows_path(model, key, dumps):
+    fields = model.json_fields
+    columns = [*(getattr(model, f) for f in fields), model.version, model.id]
+    def fetch(after, page):
+        rows = model.query.with_entities(*columns).filter(model.id > after).order_by(model.id).limit(page).all()
+        body = dumps({'success': True, key: [model.format_row(r, fields) for r in rows]})
+        assert body
+        return len(rows), rows[-1].id if rows else after
+    return fetch
+
+
+def measure(fetch, page):
+    start = time.perf_counter()
+    rows = walk(fetch, page)
+    elapsed = time.perf_counter() - start
+    return rows, rows / elapsed
+
+
+def main():
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        for model, key in ((Actor, 'actors'), (Movie, 'movies')):
+            support.seed(db, model, args.rows)
+            paths = [('orm + format() + flask json', orm_path(model, key))]
+            paths += [(f'rows + format_row() + {name}', rows_path(model, key, dumps))
+                      for name, dumps in encoding.ENCODERS.items()]
+            baseline = None
+            for name, fetch in paths:
+                measure(fetch, args.page)  # warm up
+                rows, rate = measure(fetch, args.page)
+                baseline = baseline or rate
+                print(f'{key:7} {name:36} {rows:>8} rows {rate:>12,.0f} rows/s  x{rate / baseline:.2f}')
+            db.session.close()
+
+
+if __name__ == '__main__':
+    main()
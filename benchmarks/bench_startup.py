@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Milliseconds from a fresh interpreter to each stage of starting a worker.
+
+Every stage runs `--runs` times in a new process, as a worker forked or spawned by
+gunicorn would, and the median is reported. The last stage is the first request
+of a worker, which is when the database and the JWKS are first touched:
+
+    python benchmarks/bench_startup.py --output startup.json
+    python benchmarks/bench_startup.py --compare startup.json
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+import support
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--database', default='sqlite:////tmp/bench_startup.sqlite3')
+parser.add_argument('--jwks-file', default=None)
+parser.add_argument('--runs', type=int, default=15, help='processes started per stage')
+parser.add_argument('--output', help='file to save results to, as json')
+parser.add_argument('--compare', help='results file of an earlier run to compare times against')
+args = parser.parse_args()
+
+issuer = support.configure(args.database, args.jwks_file)
+
+# each stage is timed from the top of a fresh process, after the interpreter itself started
+STAGES = {
+    'import src': 'import src',
+    'import src.app': 'import src.app',
+    'create_app()': 'from src.app import create_app; app = create_app()',
+    'first request': (
+        'from src.app import create_app; client = create_app().test_client(); '
+        'assert client.get("/actors?limit=1", headers={"Authorization": "Bearer " + TOKEN}).status_code == 200'
+    ),
+}
+SETUP = '''
+from src.app import create_app
+from src.models import db
+app = create_app()
+with app.app_context():
+    db.create_all()
+'''
+
+
+def run(code, token=''):
+    """Milliseconds `code` took in a new process"""
+    timed = f'import time\nstart = time.perf_counter()\nTOKEN = {token!r}\n{code}\nprint((time.perf_counter() - start) * 1000)'
+    out = subprocess.run(
+        [sys.executable, '-c', timed], cwd=support.ROOT, env={**os.environ, 'PYTHONPATH': str(support.ROOT)},
+        capture_output=True, text=True, check=True,
+    ).stdout
+    return float(out.split()[-1])
+
+
+def main():
+    run(SETUP)
+    token = issuer.token()
+    results = {}
+    for name, code in STAGES.items():
+        times = sorted(run(code, token) for _ in range(args.runs))
+        results[name] = {'median_ms': statistics.median(times), 'min_ms': times[0], 'max_ms': times[-1]}
+        print(f'{name:20} median {results[name]["median_ms"]:>8.1f}ms  min {times[0]:>8.1f}ms  max {times[-1]:>8.1f}ms')
+    if args.output:
+        settings = {k: v for k, v in vars(args).items() if k not in ('output', 'compare')}
+        support.save_results(args.output, 'startup', settings, results)
+    if args.compare:
+        support.compare(args.compare, results, 'median_ms', higher_is_better=False)
+
+
+if __name__ == '__main__':
+    main()
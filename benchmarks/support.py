@@ -0,0 +1,117 @@
+"""Shared pieces of the benchmarks: environment, local tokens, seeding and result files.
+
+`configure()` has to run before anything from `src` is imported, as `src` reads
+its tuning knobs from the environment at import time.
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+import rsa
+from jose import jwt
+from jose.utils import long_to_base64
+
+ROOT = Path(__file__).resolve().parent.parent
+DOMAIN = 'bench.local'
+AUDIENCE = 'bench'
+KID = 'bench'
+PERMISSIONS = [
+    f'{action}:{resource}'
+    for resource in ('actor', 'movie')
+    for action in ('read', 'add', 'update', 'delete')
+]
+SEED_CHUNK = 10_000
+
+
+class LocalIssuer:
+    """Signs RS256 tokens with a fresh key, published in a local JWKS file
+    that `src.auth` reads instead of fetching Auth0's
+    """
+
+    def __init__(self, jwks_file):
+        public_key, private_key = rsa.newkeys(2048)
+        self.private_pem = private_key.save_pkcs1().decode()
+        with open(jwks_file, 'w') as f:
+            json.dump({'keys': [{
+                'kty': 'RSA', 'kid': KID, 'use': 'sig', 'alg': 'RS256',
+                'n': long_to_base64(public_key.n).decode(),
+                'e': long_to_base64(public_key.e).decode(),
+            }]}, f)
+
+    def token(self, permissions=PERMISSIONS, sub='auth0|bench', ttl=3600):
+        now = int(time.time())
+        return jwt.encode({
+            'iss': f'https://{DOMAIN}/', 'aud': AUDIENCE, 'sub': sub,
+            'iat': now, 'exp': now + ttl, 'permissions': permissions,
+        }, self.private_pem, algorithm='RS256', headers={'kid': KID})
+
+
+def configure(database, jwks_file=None):
+    """Points `src` at `database` and at a local JWKS, returns the issuer of tokens it accepts"""
+    sys.path.insert(0, str(ROOT))
+    jwks_file = jwks_file or os.path.join(tempfile.gettempdir(), 'bench.jwks.json')
+    os.environ['DATABASE'] = database
+    os.environ['AUTH0_DOMAIN'] = DOMAIN
+    os.environ['API_AUDIENCE'] = AUDIENCE
+    os.environ['JWKS_FILE'] = jwks_file
+    return LocalIssuer(jwks_file)
+
+
+def seed(db, model, rows):
+    """Tops the table of `model` up to `rows` rows, so big volumes are only inserted once"""
+    existing = db.session.query(model).count()
+    for start in range(existing, rows, SEED_CHUNK):
+        indexes = range(start, min(rows, start + SEED_CHUNK))
+        if model.__tablename__ == 'actor':
+            batch = [dict(name=f'Actor {i}', age=20 + i % 50, gender=i % 2) for i in indexes]
+        else:
+            batch = [dict(title=f'Movie {i}', release_date=date(2000, 1, 1) + timedelta(days=i % 8000)) for i in indexes]
+        db.session.execute(model.__table__.insert(), batch)
+        db.session.commit()
+    return max(existing, rows)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(path, benchmark, settings, results):
+    with open(path, 'w') as f:
+        json.dump({
+            'benchmark': benchmark,
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'settings': settings,
+            'results': results,
+        }, f, indent=2)
+
+
+def compare(path, results, metric, higher_is_better=True):
+    """Prints the change of `metric` of each result against a previously saved file"""
+    with open(path) as f:
+        baseline = json.load(f)['results']
+    for name, result in results.items():
+        before = baseline.get(name, {}).get(metric)
+        if not before or result.get(metric) is None:
+            continue
+        change = result[metric] / before - 1
+        worse = change < 0 if higher_is_better else change > 0
+        print(f'{name:40} {metric} {before:>12,.1f} -> {result[metric]:>12,.1f}  {change:+.1%}{"  REGRESSION" if worse and abs(change) > 0.1 else ""}')
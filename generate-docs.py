@@ -31,6 +31,7 @@ re_route = re.compile(r"@app\.route\('(?P<endpoint>[-/<>:\w]+)'(, methods=\['(?P
 re_perm = re.compile(r"@requires_auth\('([\w:]+)'\)")
 re_def_name = re.compile(r"def (\w+)\(")
 re_abort = re.compile(r"abort\((\d+)\)")
+re_related = re.compile(r"/<int:pk>/(actors|movies)$")
 
 re_error_handler = re.compile(r"@app.errorhandler\((\d+)\)")
 re_py_docs = re.compile(r'"""(.*?)"""', re.DOTALL)
@@ -52,8 +53,11 @@ class Route:
         match = re_perm.search(code)
         if match:
             self.perm = match.group(1)
+        elif '@requires_auth()' in code:
+            self.perm = 'any valid token'
         else:
             self.perm = None
+        self.is_internal = '@internal' in code
         match = re_def_name.search(code)
         self.name = match.group(1)
         if 'movie' in self.name:
@@ -62,24 +66,72 @@ class Route:
             self.model = Actor
         else:
             self.model = None
-        self.response_is_list = '<int:pk>' not in self.endpoint and self.method == 'GET'
+        match = re_related.search(self.endpoint)
+        self.is_related = match is not None
+        if self.is_related:
+            self.model = Actor if match.group(1) == 'actors' else Movie
+        self.is_stats = self.endpoint.startswith('/stats/')
+        self.response_is_list = (
+            ('<int:pk>' not in self.endpoint or self.is_related) and self.method == 'GET' and not self.is_stats
+        )
+        self.response_is_stream = self.endpoint.endswith('/export')
+        self.is_bulk = self.endpoint.endswith('/bulk')
         self.raises = set(re_abort.findall(code))
 
     @property
     def example_endpoint(self):
+        if self.name == 'search':
+            return f'{self.endpoint}?q=axad'
         return self.endpoint.replace('<int:pk>', '1')
 
     def example_content(self):
+        if self.is_bulk and self.method == 'POST':
+            return [self.model.example_in()]
+        if self.is_bulk and self.method == 'PATCH':
+            return {'ids': [1, 2], 'patch': self.model.example_in()}
+        if self.is_bulk or self.is_related:
+            return {'ids': [1, 2]}
         return self.model.example_in()
 
     def example_response(self):
-        if self.model is None:
+        if self.name == 'search':
+            return {
+                'success': True,
+                'results': [{'type': 'actor', 'id': 1, 'name': Actor.example_out()['name'], 'rank': 0.12}],
+                'next': None,
+            }
+        if self.model is None or self.response_is_stream:
             return
+        if self.is_bulk and self.method == 'POST':
+            return {
+                'success': True,
+                'results': [{'success': True, 'id': 1}],
+                'ids': [1],
+            }
+        if self.is_bulk:
+            return {
+                'success': True,
+                'updated' if self.method == 'PATCH' else 'deleted': [1],
+                'missing': [2],
+            }
         res = self.model.example_out()
         key = self.model.__name__.lower()
+        if self.is_stats:
+            return {
+                'success': True,
+                key + 's': self.model.example_stats(),
+            }
+        if self.is_related and self.method == 'PUT':
+            return {
+                'success': True,
+                key + 's': [res],
+            }
         if self.response_is_list:
-            res = [res]
-            key = key + 's'
+            return {
+                'success': True,
+                key + 's': [res],
+                'next': None,
+            }
         return {
             'success': True,
             key: res,
@@ -91,7 +143,7 @@ class Route:
             res.append(f'-X {self.method}')
         if self.perm:
             res.append('-H "Authorization: Bearer $token"')
-        if self.method in ['POST', 'PATCH', 'PUT']:  # though there are no put endpoints
+        if self.method in ['POST', 'PATCH', 'PUT'] or self.is_bulk:
             res.append("-H 'Content-Type: application/json'")
             if self.model:
                 res.append(f"-d '{json.dumps(self.example_content())}'")
@@ -113,7 +165,7 @@ class Route:
             f"```\n"
             f"\n"
             f"#### Permission\n"
-            f"`{self.perm or 'This endpoint is publicly available'}`"
+            f"`{self.perm or ('Only served with EXPOSE_INTERNALS on' if self.is_internal else 'This endpoint is publicly available')}`"
             f"\n"
             f"#### Raises\n"
             + ('\n'.join(
@@ -0,0 +1,44 @@
+"""gunicorn settings, read by gunicorn from the working directory: `gunicorn` alone serves the app.
+
+`SERVER_MODE` picks the app, `wsgi` (default) or `asgi`, and with it the default worker class.
+`WEB_CONCURRENCY`, `WORKER_CLASS` and `WORKER_THREADS` override the defaults below, and
+anything on the command line overrides this file.
+"""
+import os
+
+SERVER_MODE = os.environ.get('SERVER_MODE', 'wsgi')
+CPUS = os.cpu_count() or 1
+
+if SERVER_MODE == 'asgi':
+    wsgi_app = 'src.asgi:create_asgi_app()'
+    # an event loop per worker keeps a core busy on its own
+    default_class, default_workers = 'uvicorn.workers.UvicornWorker', CPUS
+else:
+    wsgi_app = 'src.app:create_app()'
+    # while some threads wait on the database, the others of the worker use the core
+    default_class, default_workers = 'gthread', CPUS * 2 + 1
+
+worker_class = os.environ.get('WORKER_CLASS', default_class)
+workers = int(os.environ.get('WEB_CONCURRENCY', default_workers))
+# no more threads than pooled connections, so a thread never waits on the pool for one.
+# gunicorn turns sync workers with threads into gthread ones, so they keep a single thread
+default_threads = os.environ.get('DB_POOL_SIZE', 5) if worker_class == 'gthread' else 1
+threads = int(os.environ.get('WORKER_THREADS', default_threads))
+
+# the app is imported and built once in the master, workers share its memory copy-on-write
+preload_app = True
+
+
+def when_ready(server):
+    if workers > 1 and os.environ.get('DATABASE_REPLICAS'):
+        server.log.warning(
+            'read-your-writes across %s workers relies on the last_write cookie, '
+            'clients not keeping cookies may read from a lagging replica after writing', workers,
+        )
+
+
+def post_fork(server, worker):
+    # engines the master connected are disposed of by `src.pool` on fork already,
+    # kept here so a worker never shares a connection whatever forked it
+    from src.pool import dispose_engines
+    dispose_engines()
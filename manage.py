@@ -2,13 +2,14 @@
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from src.app import APP
+from src.app import create_app
 from src.models import setup_db, db
 
-setup_db(APP)
+app = create_app()
+setup_db(app)
 
-migrate = Migrate(APP, db)
-manager = Manager(APP)
+migrate = Migrate(app, db)
+manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
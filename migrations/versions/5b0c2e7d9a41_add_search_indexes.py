@@ -0,0 +1,48 @@
+"""add full-text search indexes
+
+Revision ID: 5b0c2e7d9a41
+Revises: e2d15584d5a9
+Create Date: 2026-10-18 04:12:09.531274
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5b0c2e7d9a41'
+down_revision = 'e2d15584d5a9'
+branch_labels = None
+depends_on = None
+
+# (table, column) pairs, see `search_index` in src/models.py
+SEARCHED = [('actor', 'name'), ('movie', 'title')]
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    for table, column in SEARCHED:
+        if dialect == 'postgresql':
+            op.execute(f"CREATE INDEX ix_{table}_{column}_search ON {table} USING gin (to_tsvector('simple', {column}))")
+        elif dialect == 'sqlite':
+            fts = f'{table}_search'
+            op.execute(f"CREATE VIRTUAL TABLE {fts} USING fts5({column}, content='{table}', content_rowid='id')")
+            op.execute(f"CREATE TRIGGER {fts}_insert AFTER INSERT ON {table} BEGIN "
+                       f"INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column}); END")
+            op.execute(f"CREATE TRIGGER {fts}_delete AFTER DELETE ON {table} BEGIN "
+                       f"INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column}); END")
+            op.execute(f"CREATE TRIGGER {fts}_update AFTER UPDATE OF {column} ON {table} BEGIN "
+                       f"INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column}); "
+                       f"INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column}); END")
+            # index the rows already there
+            op.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table, column in SEARCHED:
+        if dialect == 'postgresql':
+            op.drop_index(f'ix_{table}_{column}_search', table_name=table)
+        elif dialect == 'sqlite':
+            for trigger in ('insert', 'delete', 'update'):
+                op.execute(f'DROP TRIGGER {table}_search_{trigger}')
+            op.execute(f'DROP TABLE {table}_search')
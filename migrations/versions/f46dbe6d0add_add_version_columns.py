@@ -0,0 +1,34 @@
+"""add version and updated_at columns
+
+Revision ID: f46dbe6d0add
+Revises: 775a398463d0
+Create Date: 2026-10-18 01:45:12.361208
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f46dbe6d0add'
+down_revision = '775a398463d0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    sqlite = op.get_bind().dialect.name == 'sqlite'
+    # utc, as the models write datetime.utcnow(), so old and new rows agree; CURRENT_TIMESTAMP is utc on sqlite
+    now = sa.text('CURRENT_TIMESTAMP') if sqlite else sa.text("timezone('utc', now())")
+    for table in ('actor', 'movie'):
+        # sqlite can't add a column with a non-constant default in place, the table is copied instead
+        with op.batch_alter_table(table, recreate='always' if sqlite else 'auto') as batch_op:
+            batch_op.add_column(sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+            batch_op.add_column(sa.Column('updated_at', sa.DateTime(), server_default=now, nullable=False))
+
+
+def downgrade():
+    for table in ('movie', 'actor'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('updated_at')
+            batch_op.drop_column('version')
@@ -1 +1,8 @@
-from .app import APP
+def __getattr__(name):
+    """`src.APP`, as in `gunicorn src:APP`, is created on first access, importing `src` has no side effects"""
+    if name == 'APP':
+        from .app import create_app
+        global APP
+        APP = create_app()
+        return APP
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
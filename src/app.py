@@ -1,24 +1,420 @@
+import hashlib
+import json
+import os
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from datetime import date
+from functools import wraps
 from sys import exc_info
 
-from flask import Flask, request, abort
+from flask import Flask, Response, current_app, request, abort, stream_with_context
 from flask_cors import CORS
+from sqlalchemy import bindparam, tuple_
 from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.http import quote_etag, http_date
 
-from .auth import requires_auth, AuthError
-from .models import setup_db, Actor, Movie, db
+from .auth import requires_auth, AuthError, token_cache
+from . import encoding
+from .cache import setup_cache, resource_cache
+from .compression import setup_compression
+from .groupcommit import group_committer, setup_group_commit
+from .metrics import METRICS_ENABLED, registry, setup_metrics, span
+from .pool import pool_stats
+from .queries import setup_query_recorder
+from .ratelimit import setup_rate_limit
+from .models import setup_db, Actor, Movie, db, cast
+from .routing import set_write_cookie
+from .search import SEARCHABLE, search_terms, search_page, decode_cursor as decode_search_cursor
 
 # !!WARN: NEVER PUT BLANK LINES INSIDE FUNCTIONS
 # ..INFO: YOU CAN PUT A HASH (#) INSTEAD
 # !!WARN: ALWAYS PUT AT LEAST A SINGLE BLANK LINE BETWEEN FUNCTIONS
 # ..INFO: THIS IS DUE TO HOW DOCS GENERATOR WORKS
 
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 1000))
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 1000))
+EXPOSE_INTERNALS = os.environ.get('EXPOSE_INTERNALS', '') in ('1', 'true', 'yes')
+
+
+ACTOR_FILTERS = {
+    'age_min': lambda v: Actor.age >= int(v),
+    'age_max': lambda v: Actor.age <= int(v),
+    'gender': lambda v: Actor.gender == int(v),
+    'name_prefix': lambda v: Actor.name.startswith(v, autoescape=True),
+}
+ACTOR_SORTS = ('id', 'name', 'age')
+ACTOR_INCLUDES = ('movies',)
+MOVIE_FILTERS = {
+    'release_from': lambda v: Movie.release_date >= date.fromisoformat(v),
+    'release_to': lambda v: Movie.release_date <= date.fromisoformat(v),
+    'title_prefix': lambda v: Movie.title.startswith(v, autoescape=True),
+}
+MOVIE_SORTS = ('id', 'title', 'release_date')
+MOVIE_INCLUDES = ('actors',)
+
+
+def filter_query(model, filters, req=request):
+    """`model.query` narrowed down by the filters given in query string"""
+    query = model.query
+    for arg, condition in filters.items():
+        if arg in req.args:
+            try:
+                query = query.filter(condition(req.args[arg]))
+            except ValueError:
+                abort(400)
+    return query
+
+
+def encode_cursor(value, pk):
+    if isinstance(value, date):
+        value = value.isoformat()
+    return urlsafe_b64encode(json.dumps([value, pk]).encode()).decode()
+
+
+def decode_cursor(cursor, column):
+    value, pk = json.loads(urlsafe_b64decode(cursor.encode()))
+    if column.type.python_type is date:
+        value = date.fromisoformat(value)
+    return value, int(pk)
+
+
+def paginate(query, model, sorts=('id',), columns=None):
+    """Keyset pagination: `?after=<cursor>&limit=N&sort=[-]field`, seeks instead of OFFSET.
+    The cursor is the id of the last row when sorted by id, an opaque string otherwise.
+    Rows with an empty sort field are left out. If `columns` are given only they are
+    selected, followed by id and the sort field.
+    Returns a page of items and the cursor of the next page (None if it's the last one)
+    """
+    query, finish = page_query(query, model, sorts, columns)
+    return finish(query.all())
+
+
+def page_query(query, model, sorts=('id',), columns=None, req=request):
+    """`paginate` split in two, for callers running the query themselves.
+    Returns the query of the page and a function turning its rows into `paginate`'s result
+    """
+    sort = req.args.get('sort', 'id')
+    if sort.lstrip('-') not in sorts:
+        abort(400)
+    descending = sort.startswith('-')
+    order = getattr(model, sort.lstrip('-'))
+    limit = req.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    if limit < 1:
+        abort(400)
+    limit = min(limit, MAX_PAGE_SIZE)
+    keys = [model.id] if order is model.id else [order, model.id]
+    if columns is not None:
+        query = query.with_entities(*columns, *keys)
+    if order is not model.id:
+        query = query.filter(order.isnot(None))
+    key = tuple_(*keys) if len(keys) > 1 else model.id
+    after = req.args.get('after')
+    if after is not None:
+        try:
+            after = int(after) if order is model.id else tuple_(*decode_cursor(after, order))
+        except (ValueError, TypeError):
+            abort(400)
+        query = query.filter(key < after if descending else key > after)
+    # fetch one extra row to know if there is a next page
+    query = query.order_by(*(k.desc() if descending else k for k in keys)).limit(limit + 1)
+    def finish(items):
+        if len(items) <= limit:
+            return items, None
+        items = items[:limit]
+        if order is model.id:
+            return items, items[-1].id
+        return items, encode_cursor(getattr(items[-1], order.key), items[-1].id)
+    return query, finish
+
+
+def requested_fields(model, req=request):
+    """Fields asked for with `?fields=id,name`, None if all of them"""
+    if 'fields' not in req.args:
+        return None
+    fields = list(dict.fromkeys(f for f in req.args['fields'].split(',') if f))
+    if not fields or any(f not in model.json_fields for f in fields):
+        abort(400)
+    return fields
+
+
+def requested_include(includes):
+    """Relationship asked for with `?include=`, None if none"""
+    include = request.args.get('include')
+    if include is not None and include not in includes:
+        abort(400)
+    return include
+
+
+def get_page(query, model, sorts, include=None):
+    """A formatted page of `query`. Only the columns to return are selected, as plain rows
+    instead of ORM objects, `?fields=` narrows them down further.
+    `include` names a relationship embedded in every item, loaded in a fixed number of queries.
+    Returns items, the cursor of the next page and the page's ETag
+    """
+    fields = requested_fields(model) or model.json_fields
+    columns = [*(getattr(model, f) for f in fields), model.version]
+    rows, next_cursor = paginate(query, model, sorts, columns=columns)
+    with span('format'):
+        items = [model.format_row(r, fields) for r in rows]
+    if include is None:
+        return items, next_cursor, page_etag(rows, next_cursor)
+    related = model.load_related([r.id for r in rows], include)
+    with span('format'):
+        for item, row in zip(items, rows):
+            item[include] = [r.format() for r in related.get(row.id, [])]
+    return items, next_cursor, page_etag(rows, next_cursor, related)
+
+
+def page_response(query, model, key, sorts, include=None):
+    """`get_page` as a response with its ETag, or 304 if the client's copy is fresh.
+    Without `include` a conditional request first selects only the versions of the page's rows
+    """
+    if request.if_none_match and include is None:
+        versions, next_cursor = paginate(query, model, sorts, columns=[model.version])
+        if is_not_modified(page_etag(versions, next_cursor)):
+            return not_modified(page_etag(versions, next_cursor))
+    items, next_cursor, etag = get_page(query, model, sorts, include)
+    if include is not None and is_not_modified(etag):
+        return not_modified(etag)
+    return json_response({
+        'success': True,
+        key: items,
+        'next': next_cursor,
+    }, headers={'ETag': quote_etag(etag)})
+
+
+def internal(f):
+    """Hides a view of the app's internals behind 404 unless the `EXPOSE_INTERNALS` config is on"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if not current_app.config['EXPOSE_INTERNALS']:
+            abort(404)
+        return f(*args, **kwargs)
+    return wrapper
+
+
+def json_response(body, status=200, headers=None):
+    """Same as returning a dict from a view, but encoded with the fast encoder"""
+    with span('encode'):
+        body = encoding.dumps(body)
+    return Response(body, status, headers, mimetype='application/json')
+
+
+def ndjson_export(model):
+    """Streams every row of `model` as newline delimited json, honouring `?fields=`.
+    Rows are fetched `EXPORT_CHUNK_SIZE` at a time through a server-side cursor,
+    so memory stays flat and the first line goes out right away
+    """
+    fields = requested_fields(model) or model.json_fields
+    query = model.query.with_entities(*(getattr(model, f) for f in fields)).order_by(model.id)
+    def generate():
+        try:
+            for row in query.yield_per(EXPORT_CHUNK_SIZE):
+                yield encoding.dumps(model.format_row(row, fields)) + b'\n'
+        finally:
+            db.session.close()
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def bulk_items():
+    """Items of a bulk request, the body is either a json array or NDJSON"""
+    if request.mimetype == 'application/x-ndjson':
+        try:
+            return [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+        except ValueError:
+            abort(400)
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        abort(400)
+    return items
+
+
+def chunks(items, size=BULK_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def bulk_insert(model, items):
+    """Validates all `items` in one pass and inserts the valid ones in a single transaction,
+    `BULK_CHUNK_SIZE` rows per executemany. Postgres gets them as multi-row INSERT ... RETURNING,
+    sqlite one INSERT per row, for the ids to return. Returns per-item results
+    """
+    results = []
+    rows = []
+    for item in items:
+        try:
+            rows.append(model.fields_from_json(item))
+            results.append({'success': True})
+        except (ValueError, TypeError):
+            results.append({'success': False, 'error': 400})
+    try:
+        for chunk in chunks(rows):
+            db.session.bulk_insert_mappings(model, chunk, return_defaults=True)
+        db.session.commit()
+        resource_cache.delete(model.stats_key())
+    except SQLAlchemyError:
+        print(exc_info())
+        db.session.rollback()
+        abort(422)
+    finally:
+        db.session.close()
+    inserted = [r for r in results if r['success']]
+    for result, row in zip(inserted, rows):
+        result['id'] = row['id']
+    return {
+        'success': True,
+        'results': results,
+        'ids': [row['id'] for row in rows],
+    }
+
+
+def existing_ids(model, ids):
+    found = set()
+    for chunk in chunks(ids):
+        found.update(pk for pk, in db.session.query(model.id).filter(model.id.in_(chunk)))
+    return found
+
+
+def bulk_update(model):
+    """Either applies one `patch` to all `ids` with UPDATE ... WHERE id IN (...),
+    or applies `patches` mapping of id -> patch. Everything is done in one transaction,
+    after every patch was validated like the items of `bulk_insert`, only with fields left out
+    """
+    data = request.get_json(silent=True)
+    try:
+        if 'patches' in data:
+            patches = {int(pk): patch for pk, patch in data['patches'].items()}
+        else:
+            patches = {int(pk): data['patch'] for pk in data['ids']}
+        patches = {pk: model.fields_from_json(patch, partial=True) for pk, patch in patches.items()}
+    except (TypeError, ValueError, KeyError, AttributeError):
+        abort(400)
+    if not all(patches.values()):
+        abort(400)
+    try:
+        found = existing_ids(model, list(patches))
+        if 'patches' in data:
+            # one executemany UPDATE per distinct set of patched fields
+            groups = {}
+            for pk in found:
+                groups.setdefault(tuple(sorted(patches[pk])), []).append(dict(patches[pk], pk=pk))
+            for keys, params in groups.items():
+                db.session.execute(
+                    model.__table__.update()
+                    .where(model.id == bindparam('pk'))
+                    .values(**{k: bindparam(k) for k in keys}, **model.version_bump()),
+                    params,
+                )
+        elif found:
+            patch = dict(next(iter(patches.values())), **model.version_bump())
+            for chunk in chunks(list(found)):
+                model.query.filter(model.id.in_(chunk)).update(patch, synchronize_session=False)
+        db.session.commit()
+        resource_cache.delete(model.stats_key(), *(model.cache_key(pk) for pk in found))
+        return {
+            'success': True,
+            'updated': sorted(found),
+            'missing': [pk for pk in patches if pk not in found],
+        }
+    except SQLAlchemyError:
+        print(exc_info())
+        db.session.rollback()
+        abort(422)
+    finally:
+        db.session.close()
+
+
+def bulk_delete(model):
+    """Deletes all `ids` with DELETE ... WHERE id IN (...) in one transaction"""
+    data = request.get_json(silent=True)
+    try:
+        ids = [int(pk) for pk in data['ids']]
+    except (TypeError, ValueError, KeyError):
+        abort(400)
+    try:
+        found = existing_ids(model, ids)
+        for chunk in chunks(list(found)):
+            model.query.filter(model.id.in_(chunk)).delete(synchronize_session=False)
+        db.session.commit()
+        resource_cache.delete(model.stats_key(), *(model.cache_key(pk) for pk in found))
+        return {
+            'success': True,
+            'deleted': sorted(found),
+            'missing': [pk for pk in ids if pk not in found],
+        }
+    except SQLAlchemyError:
+        print(exc_info())
+        db.session.rollback()
+        abort(422)
+    finally:
+        db.session.close()
+
+
+def is_not_modified(etag, updated_at=None, req=request):
+    """Checks conditional request headers, If-None-Match wins over If-Modified-Since"""
+    if req.if_none_match:
+        # weak comparison, compressed responses carry weak ETags
+        return req.if_none_match.contains_weak(etag)
+    if updated_at is not None and req.if_modified_since is not None:
+        return updated_at.replace(microsecond=0) <= req.if_modified_since
+    return False
+
+
+def not_modified(etag):
+    return '', 304, {'ETag': quote_etag(etag)}
+
+
+def get_conditional(model, pk, key):
+    """Single resource response with ETag and Last-Modified, or 304 if the client's copy is fresh.
+    Without a cache a conditional request only looks up the row's version, not the row.
+    `?fields=` selects only the requested columns. Returns None if there is no such row
+    """
+    conditional = request.if_none_match or request.if_modified_since
+    if conditional and resource_cache.backend is None:
+        version = model.get_version(pk)
+        if version is None:
+            return None
+        if is_not_modified(*version):
+            return not_modified(version[0])
+    fields = requested_fields(model)
+    formatted = model.get_formatted(pk) if fields is None else model.get_partial(pk, fields)
+    if formatted is None:
+        return None
+    payload, etag, updated_at = formatted
+    if conditional and is_not_modified(etag, updated_at):
+        return not_modified(etag)
+    return {
+        'success': True,
+        key: payload,
+    }, 200, {'ETag': quote_etag(etag), 'Last-Modified': http_date(updated_at)}
+
+
+def page_etag(rows, next_cursor=None, related=None):
+    """ETag of a list page, changes whenever a row of the page is added, changed or deleted,
+    and with the cursor of the next page, which appears once a row is added past a full page.
+    `related` maps ids of the rows to their embedded rows, which it changes with as well
+    """
+    versions = ','.join(f'{row.id}:{row.version}' for row in rows)
+    if related is not None:
+        versions += ';' + ','.join(f'{pk}:{r.id}:{r.version}' for pk in sorted(related) for r in related[pk])
+    return hashlib.md5(f'{versions}|{next_cursor}'.encode()).hexdigest()
+
 
 def create_app():
     # create and configure the app
     app = Flask(__name__)
     CORS(app)
+    app.config['EXPOSE_INTERNALS'] = EXPOSE_INTERNALS
     setup_db(app)
+    setup_group_commit(app, db)
+    setup_cache()
+    if METRICS_ENABLED:
+        setup_metrics(app)
+    setup_query_recorder(app)
+    setup_rate_limit(app)
+    setup_compression(app)
+    app.after_request(set_write_cookie)
     @app.after_request
     def after_request(response):
         header = response.headers
@@ -31,6 +427,36 @@ def create_app():
     def index():
         return {'message': 'hello world'}
 
+    @app.route('/internal/cache')
+    @internal
+    def get_cache_stats():
+        """Hit/miss counters of the resource and token caches"""
+        return {
+            'success': True,
+            'resources': resource_cache.stats(),
+            'tokens': token_cache.stats(),
+        }
+
+    @app.route('/internal/pool')
+    @internal
+    def get_pool_stats():
+        """Connections of the database pool, how long requests waited for one
+        and the rows per transaction of group commit
+        """
+        return {
+            'success': True,
+            'pool': pool_stats(db.engine.pool),
+            'group_commit': group_committer.stats(),
+        }
+
+    @app.route('/metrics')
+    @internal
+    def get_metrics():
+        """Latency histograms of requests and their phases in Prometheus text format,
+        empty unless `METRICS` is on
+        """
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
     @app.route('/headers')
     @requires_auth()
     def get_jwt_contents(payload):
@@ -39,19 +465,40 @@ def create_app():
     @app.route('/actors')
     @requires_auth('read:actor')
     def get_actors(_p):
-        """No pagination"""
-        return {
+        """Paginated with `?after=<cursor>&limit=N`, pass `next` as `after` to get the next page.
+        Sorted with `?sort=[-]field`, see docs for filters
+        """
+        query = filter_query(Actor, ACTOR_FILTERS)
+        include = requested_include(ACTOR_INCLUDES)
+        return page_response(query, Actor, 'actors', ACTOR_SORTS, include)
+
+    @app.route('/stats/actors')
+    @requires_auth('read:actor')
+    def get_actor_stats(_p):
+        """Actor counts by gender and age, cached until the next write of actors"""
+        return json_response({
             'success': True,
-            'actors': [a.format() for a in Actor.query.order_by(Actor.id).all()]
-        }
+            'actors': Actor.get_stats(),
+        })
+
+    @app.route('/actors/export')
+    @requires_auth('read:actor')
+    def export_actors(_p):
+        """Streams all actors as NDJSON, one actor per line"""
+        return ndjson_export(Actor)
 
     @app.route('/actors/<int:pk>')
     @requires_auth('read:actor')
     def get_actor(_p, pk: int):
-        return {
-            'success': True,
-            'actor': (Actor.query.get(pk) or abort(404)).format(),
-        }
+        return get_conditional(Actor, pk, 'actor') or abort(404)
+
+    @app.route('/actors/<int:pk>/movies')
+    @requires_auth('read:movie')
+    def get_actor_movies(_p, pk: int):
+        """Movies the actor plays in, paginated, sorted and filtered like `/movies`"""
+        Actor.get_version(pk) or abort(404)
+        query = filter_query(Movie, MOVIE_FILTERS).join(cast, cast.c.movie_id == Movie.id).filter(cast.c.actor_id == pk)
+        return page_response(query, Movie, 'movies', MOVIE_SORTS)
 
     @app.route('/actors', methods=['POST'])
     @requires_auth('add:actor')
@@ -74,6 +521,12 @@ def create_app():
         finally:
             db.session.close()
 
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('add:actor')
+    def add_actors(_p):
+        """Accepts a json array or NDJSON of actors, invalid items are reported and skipped"""
+        return bulk_insert(Actor, bulk_items())
+
     @app.route('/actors/<int:pk>', methods=['PATCH'])
     @requires_auth('update:actor')
     def update_actor(_p, pk: int):
@@ -94,6 +547,12 @@ def create_app():
         finally:
             db.session.close()
 
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @requires_auth('update:actor')
+    def update_actors(_p):
+        """Accepts either `ids` with a single `patch` or `patches` mapping of id to patch"""
+        return bulk_update(Actor)
+
     @app.route('/actors/<int:pk>', methods=['DELETE'])
     @requires_auth('delete:actor')
     def delete_actor(_p, pk: int):
@@ -107,22 +566,76 @@ def create_app():
         finally:
             db.session.close()
 
+    @app.route('/actors/bulk', methods=['DELETE'])
+    @requires_auth('delete:actor')
+    def delete_actors(_p):
+        """Accepts `ids` to delete, ids which don't exist are reported as `missing`"""
+        return bulk_delete(Actor)
+
     @app.route('/movies')
     @requires_auth('read:movie')
     def get_movies(_p):
-        """No pagination"""
-        return {
+        """Paginated with `?after=<cursor>&limit=N`, pass `next` as `after` to get the next page.
+        Sorted with `?sort=[-]field`, see docs for filters
+        """
+        query = filter_query(Movie, MOVIE_FILTERS)
+        include = requested_include(MOVIE_INCLUDES)
+        return page_response(query, Movie, 'movies', MOVIE_SORTS, include)
+
+    @app.route('/stats/movies')
+    @requires_auth('read:movie')
+    def get_movie_stats(_p):
+        """Movie counts by release year, cached until the next write of movies"""
+        return json_response({
             'success': True,
-            'movies': [m.format() for m in Movie.query.order_by(Movie.id).all()]
-        }
+            'movies': Movie.get_stats(),
+        })
+
+    @app.route('/movies/export')
+    @requires_auth('read:movie')
+    def export_movies(_p):
+        """Streams all movies as NDJSON, one movie per line"""
+        return ndjson_export(Movie)
 
     @app.route('/movies/<int:pk>')
     @requires_auth('read:movie')
     def get_movie(_p, pk: int):
-        return {
-            'success': True,
-            'movie': (Movie.query.get(pk) or abort(404)).format(),
-        }
+        return get_conditional(Movie, pk, 'movie') or abort(404)
+
+    @app.route('/movies/<int:pk>/actors')
+    @requires_auth('read:actor')
+    def get_movie_actors(_p, pk: int):
+        """Cast of the movie, paginated, sorted and filtered like `/actors`"""
+        Movie.get_version(pk) or abort(404)
+        query = filter_query(Actor, ACTOR_FILTERS).join(cast, cast.c.actor_id == Actor.id).filter(cast.c.movie_id == pk)
+        return page_response(query, Actor, 'actors', ACTOR_SORTS)
+
+    @app.route('/movies/<int:pk>/actors', methods=['PUT'])
+    @requires_auth('update:movie')
+    def set_movie_actors(_p, pk: int):
+        """Replaces the cast of the movie with the actors `ids`"""
+        data = request.get_json(silent=True)
+        try:
+            ids = {int(i) for i in data['ids']}
+        except (TypeError, ValueError, KeyError):
+            abort(400)
+        m = Movie.query.get(pk) or abort(404)
+        actors = Actor.query.filter(Actor.id.in_(ids)).all() if ids else []
+        if len(actors) != len(ids):
+            abort(422)
+        try:
+            m.actors = actors
+            # bumps the movie's version, so its ETag changes with the cast
+            m.update()
+            return {
+                'success': True,
+                'actors': [a.format() for a in m.actors],
+            }
+        except SQLAlchemyError:
+            print(exc_info())
+            abort(422)
+        finally:
+            db.session.close()
 
     @app.route('/movies', methods=['POST'])
     @requires_auth('add:movie')
@@ -146,6 +659,12 @@ def create_app():
         finally:
             db.session.close()
 
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('add:movie')
+    def add_movies(_p):
+        """Accepts a json array or NDJSON of movies, invalid items are reported and skipped"""
+        return bulk_insert(Movie, bulk_items())
+
     @app.route('/movies/<int:pk>', methods=['PATCH'])
     @requires_auth('update:movie')
     def update_movie(_p, pk: int):
@@ -166,6 +685,12 @@ def create_app():
         finally:
             db.session.close()
 
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @requires_auth('update:movie')
+    def update_movies(_p):
+        """Accepts either `ids` with a single `patch` or `patches` mapping of id to patch"""
+        return bulk_update(Movie)
+
     @app.route('/movies/<int:pk>', methods=['DELETE'])
     @requires_auth('delete:movie')
     def delete_movie(_p, pk: int):
@@ -179,6 +704,41 @@ def create_app():
         finally:
             db.session.close()
 
+    @app.route('/movies/bulk', methods=['DELETE'])
+    @requires_auth('delete:movie')
+    def delete_movies(_p):
+        """Accepts `ids` to delete, ids which don't exist are reported as `missing`"""
+        return bulk_delete(Movie)
+
+    @app.route('/search')
+    @requires_auth()
+    def search(payload):
+        """Actors by name and movies by title, best matches first. Every word of `?q=` matches
+        words starting with it. `?type=actor` or `?type=movie` searches only one of them,
+        only those the token can read are searched. Paginated with `?after=<cursor>&limit=N`
+        """
+        terms = search_terms(request.args.get('q', ''))
+        kind = request.args.get('type')
+        if not terms or kind not in (None, *SEARCHABLE):
+            abort(400)
+        kinds = [k for k in SEARCHABLE if kind in (None, k) and f'read:{k}' in payload['permissions']]
+        if not kinds:
+            abort(403)
+        limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+        if limit < 1:
+            abort(400)
+        after = request.args.get('after')
+        try:
+            after = after and decode_search_cursor(after)
+        except (ValueError, TypeError):
+            abort(400)
+        results, next_cursor = search_page(terms, kinds, after or None, min(limit, MAX_PAGE_SIZE))
+        return json_response({
+            'success': True,
+            'results': results,
+            'next': next_cursor,
+        })
+
     @app.errorhandler(AuthError)
     def auth_error(e: AuthError):
         return {
@@ -222,6 +782,15 @@ def create_app():
                    'message': 'unprocessable',
                }, 422
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        """Raised if the client used up its request budget, `Retry-After` tells in how many seconds to retry"""
+        return {
+                   'success': False,
+                   'error': 429,
+                   'message': 'too many requests',
+               }, 429, {'Retry-After': str(error.retry_after)}
+
     @app.errorhandler(500)
     def internal_server_error(_error):
         """Raised if the server failed to fulfill the request"""
@@ -234,7 +803,5 @@ def create_app():
     return app
 
 
-APP = create_app()
-
 if __name__ == '__main__':
-    APP.run(host='0.0.0.0', port=8080, debug=True)
+    create_app().run(host='0.0.0.0', port=8080, debug=True)
@@ -0,0 +1,263 @@
+"""ASGI entry point, served with `uvicorn src.asgi:app` or gunicorn's uvicorn workers.
+
+Reads of actors and movies, the bulk of the traffic, are async handlers on an async
+driver (asyncpg, aiosqlite), so a process keeps thousands of them in flight while
+they wait on the database. Every other route is the flask app running in a thread pool.
+"""
+import asyncio
+import itertools
+import os
+from sys import exc_info
+
+from a2wsgi import WSGIMiddleware
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.exceptions import HTTPException, NotFound
+from werkzeug.http import quote_etag, http_date
+from werkzeug.routing import Map, Rule
+from werkzeug.wrappers import Request
+
+from . import encoding
+from .app import (
+    create_app, ACTOR_FILTERS, ACTOR_SORTS, MOVIE_FILTERS, MOVIE_SORTS,
+    filter_query, page_query, requested_fields, is_not_modified, page_etag,
+)
+from .auth import AuthError, key_store, token_cache, get_token_auth_header, verify_decode_jwt, check_permissions
+from .cache import resource_cache
+from .compression import COMPRESS_MIN_SIZE, compress_body, negotiate
+from .metrics import METRICS_ENABLED, RequestTimer, current_timer, registry, span
+from .models import Actor, Movie, db, make_etag
+from .pool import engines, pool_options
+from .ratelimit import rate_limiter
+from .routing import wrote_recently
+
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+ERROR_MESSAGES = {
+    400: 'bad request', 403: 'forbidden', 404: 'not found', 429: 'too many requests', 500: 'internal server error',
+}
+HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Authorization, Content-Type',
+    'Access-Control-Allow-Methods': '*',
+}
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 10))
+
+
+def async_engine(url):
+    """Engine of the same database as the sync engine of `url`, on its async driver"""
+    options = pool_options(str(url))
+    # the async engine brings its own pool class
+    options.pop('poolclass', None)
+    url = url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+    engine = create_async_engine(url, **options)
+    engines.add(engine.sync_engine)
+    return engine
+
+
+def encode(body):
+    with span('encode'):
+        return encoding.dumps(body)
+
+
+def build_environ(scope):
+    """Minimal WSGI environ of an ASGI http `scope`, enough for a werkzeug Request without a body"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode().decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'REMOTE_ADDR': (scope.get('client') or ('',))[0],
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        value = value.decode('latin1')
+        environ[name] = f'{environ[name]},{value}' if name in environ else value
+    return environ
+
+
+class AsyncApp:
+    """ASGI app serving the read routes of `url_map` natively and the rest with `flask_app`"""
+
+    url_map = Map([
+        Rule('/actors', endpoint='get_actors', methods=['GET']),
+        Rule('/actors/<int:pk>', endpoint='get_actor', methods=['GET']),
+        Rule('/movies', endpoint='get_movies', methods=['GET']),
+        Rule('/movies/<int:pk>', endpoint='get_movie', methods=['GET']),
+    ])
+
+    def __init__(self, flask_app):
+        self.wsgi = WSGIMiddleware(flask_app, workers=WSGI_THREADS)
+        # the flask app's databases, reads go to the replicas if there are any
+        with flask_app.app_context():
+            replicas = [db.get_engine(flask_app, bind).url for bind in flask_app.config['DATABASE_REPLICAS']]
+            self.primary = async_engine(db.engine.url)
+            self.replicas = [async_engine(url) for url in replicas] or [self.primary]
+        self.engines = list(dict.fromkeys([self.primary, *self.replicas]))
+        self._counter = itertools.count()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return await self.wsgi(scope, receive, send)
+        environ = build_environ(scope)
+        try:
+            rule, values = self.url_map.bind_to_environ(environ).match(return_rule=True)
+        except HTTPException:
+            return await self.wsgi(scope, receive, send)
+        req = Request(environ)
+        if 'include' in req.args:
+            # embedding related rows is left to the flask app
+            return await self.wsgi(scope, receive, send)
+        timer = RequestTimer() if METRICS_ENABLED else None
+        current_timer.set(timer)
+        try:
+            status, body, headers = await getattr(self, rule.endpoint)(req, **values)
+        except AuthError as e:
+            status, body, headers = e.status_code, encode({'success': False, 'error': e.error}), {}
+        except Exception as e:  # noqa
+            status = e.code if isinstance(e, HTTPException) and e.code in ERROR_MESSAGES else 500
+            if status == 500:
+                print(exc_info())
+            body = encode({'success': False, 'error': status, 'message': ERROR_MESSAGES[status]})
+            headers = {'Retry-After': str(e.retry_after)} if status == 429 else {}
+        headers = {**HEADERS, **headers}
+        if body:
+            headers['Content-Type'] = 'application/json'
+            headers['Vary'] = 'Accept-Encoding'
+            encoding = negotiate(req) if status == 200 and len(body) >= COMPRESS_MIN_SIZE else None
+            if encoding is not None and req.method != 'HEAD':
+                body = compress_body(body, encoding, cache='ETag' in headers)
+                headers['Content-Encoding'] = encoding
+                if 'ETag' in headers:
+                    headers['ETag'] = f"W/{headers['ETag']}"
+        if timer is not None:
+            total = timer.elapsed()
+            registry.observe(req.method, rule.rule, status, total, timer.spans)
+            headers['Server-Timing'] = timer.server_timing(total)
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(k.lower().encode('latin1'), v.encode('latin1')) for k, v in headers.items()],
+        })
+        await send({'type': 'http.response.body', 'body': b'' if req.method == 'HEAD' else body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for engine in self.engines:
+                    await engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def fetch(self, statement, primary=False):
+        """All rows of `statement`, from the primary or the next replica in turn"""
+        engine = self.primary if primary else self.replicas[next(self._counter) % len(self.replicas)]
+        with span('query'):
+            async with engine.connect() as connection:
+                return (await connection.execute(statement)).all()
+
+    @staticmethod
+    async def authenticate(req, permission, endpoint):
+        """`requires_auth` for async handlers, keeps signature verification off the event loop"""
+        with span('auth'):
+            key_store.start()
+            token = get_token_auth_header(req)
+            payload = token_cache.get(token)
+            if payload is None:
+                rate_limiter.check_verify(req.remote_addr)
+                payload = await asyncio.get_running_loop().run_in_executor(None, verify_decode_jwt, token)
+                token_cache.set(token, payload)
+            check_permissions(permission, payload)
+        rate_limiter.check(endpoint, payload.get('sub') or req.remote_addr)
+        return payload
+
+    @staticmethod
+    def reads_from_primary(req, payload):
+        """Whether the client wrote within the read-your-writes window, see `routing.reads_from_replica`"""
+        return wrote_recently(payload.get('sub') or req.remote_addr, req)
+
+    async def get_page(self, req, model, key, filters, sorts):
+        """Same page as the flask app's list endpoints return"""
+        payload = await self.authenticate(req, f'read:{model.__tablename__}', f'get_{key}')
+        query = filter_query(model, filters, req)
+        fields = requested_fields(model, req) or model.json_fields
+        columns = [*(getattr(model, f) for f in fields), model.version]
+        query, finish = page_query(query, model, sorts, columns, req)
+        rows, next_cursor = finish(await self.fetch(query.statement, self.reads_from_primary(req, payload)))
+        etag = page_etag(rows, next_cursor)
+        if is_not_modified(etag, req=req):
+            return 304, b'', {'ETag': quote_etag(etag)}
+        with span('format'):
+            items = [model.format_row(r, fields) for r in rows]
+        return 200, encode({
+            'success': True,
+            key: items,
+            'next': next_cursor,
+        }), {'ETag': quote_etag(etag)}
+
+    async def get_one(self, req, model, pk):
+        """Same as the flask app's `get_conditional`, goes through the resource cache too"""
+        payload = await self.authenticate(req, f'read:{model.__tablename__}', f'get_{model.__tablename__}')
+        primary = self.reads_from_primary(req, payload)
+        fields = requested_fields(model, req)
+        selected = fields or model.json_fields
+        statement = (
+            select(*(getattr(model, f) for f in selected), model.version, model.updated_at)
+            .where(model.id == pk)
+        )
+        async def load():
+            rows = await self.fetch(statement, primary)
+            if not rows:
+                return None
+            return model.format_row(rows[0], selected), make_etag(rows[0].version, rows[0].updated_at), rows[0].updated_at
+        if fields is None:
+            # rows of a replica may be lagging, only the primary's are cached
+            fill = primary or self.replicas == [self.primary]
+            formatted = await resource_cache.get_or_load_async(model.cache_key(pk), load, fill)
+        else:
+            formatted = await load()
+        if formatted is None:
+            raise NotFound()
+        payload, etag, updated_at = formatted
+        if is_not_modified(etag, updated_at, req):
+            return 304, b'', {'ETag': quote_etag(etag)}
+        return 200, encode({
+            'success': True,
+            model.__tablename__: payload,
+        }), {'ETag': quote_etag(etag), 'Last-Modified': http_date(updated_at)}
+
+    async def get_actors(self, req):
+        return await self.get_page(req, Actor, 'actors', ACTOR_FILTERS, ACTOR_SORTS)
+
+    async def get_actor(self, req, pk):
+        return await self.get_one(req, Actor, pk)
+
+    async def get_movies(self, req):
+        return await self.get_page(req, Movie, 'movies', MOVIE_FILTERS, MOVIE_SORTS)
+
+    async def get_movie(self, req, pk):
+        return await self.get_one(req, Movie, pk)
+
+
+def create_asgi_app():
+    return AsyncApp(create_app())
+
+
+def __getattr__(name):
+    """`app`, as in `uvicorn src.asgi:app`, is created on first access"""
+    if name == 'app':
+        global app
+        app = create_asgi_app()
+        return app
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
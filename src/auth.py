@@ -1,24 +1,40 @@
-import json
+import hashlib
 import os
-from pathlib import Path
+import time
+from collections import OrderedDict
+from threading import Lock
 
 from flask import request, _request_ctx_stack, abort
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+from jose.utils import base64url_decode
+
+from .jwks import KeyStore
+from .metrics import span
+from .ratelimit import rate_limiter
+from .routing import client_key
 
-AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = ['RS256']
-API_AUDIENCE = os.environ['API_AUDIENCE']
+JWT_CACHE_SIZE = int(os.environ.get('JWT_CACHE_SIZE', 1024))
+JWKS_FILE = os.environ.get('JWKS_FILE', 'auth.jwks.json')
+
+
+# the required settings are read on first use, so importing needs no configuration
+def auth0_domain():
+    return os.environ['AUTH0_DOMAIN']
+
+
+def api_audience():
+    return os.environ['API_AUDIENCE']
+
 
-JWKS_FILE = 'auth.jwks.json'
-if Path(JWKS_FILE).is_file():
-    jwks = json.load(open(JWKS_FILE, 'rb'))
-else:
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    content = jsonurl.read()
-    open(JWKS_FILE, 'wb').write(content)
-    jwks = json.loads(content)
+# keys are loaded on the first verification, not on import
+key_store = KeyStore(
+    url=lambda: f'https://{auth0_domain()}/.well-known/jwks.json',
+    file=JWKS_FILE,
+    refresh_interval=int(os.environ.get('JWKS_REFRESH_INTERVAL', 3600)),
+)
+os.register_at_fork(after_in_child=key_store.after_fork)
 
 
 class AuthError(Exception):
@@ -29,9 +45,67 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
-def get_token_auth_header():
+class TokenCache:
+    """Bounded LRU of verified jwt payloads keyed on the token hash.
+    An entry is kept until the token's `exp`, so a cache hit never outlives the token
+    """
+
+    def __init__(self, maxsize=JWT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, token, payload):
+        exp = payload.get('exp')
+        if self.maxsize <= 0 or exp is None:
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (exp, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+token_cache = TokenCache()
+
+
+def get_token_auth_header(req=request):
     """Obtains the Access Token from the Authorization Header"""
-    auth = request.headers.get('Authorization', None)
+    auth = req.headers.get('Authorization', None)
     if not auth:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -76,32 +150,30 @@ def check_permissions(permission, payload):
 
 def verify_decode_jwt(token):
     """Returns decoded payload from jwt `token`"""
-    global jwks
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-    if rsa_key:
+    key = key_store.get(unverified_header['kid'])
+    if key is not None:
         try:
+            # the signature is checked against the prebuilt key,
+            # jwt.decode is left to validate the claims
+            if unverified_header.get('alg') not in ALGORITHMS:
+                raise jwt.JWTError('The specified alg value is not allowed')
+            signing_input, _, signature = token.rpartition('.')
+            if not key.verify(signing_input.encode(), base64url_decode(signature.encode())):
+                raise jwt.JWTError('Signature verification failed.')
             payload = jwt.decode(
                 token,
-                rsa_key,
+                '',
                 algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                options={'verify_signature': False},
+                audience=api_audience(),
+                issuer='https://' + auth0_domain() + '/'
             )
 
             return payload
@@ -134,11 +206,21 @@ def requires_auth(permission=None):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            with span('auth'):
+                key_store.start()
+                token = get_token_auth_header()
+                payload = token_cache.get(token)
+                if payload is None:
+                    rate_limiter.check_verify(request.remote_addr)
+                    payload = verify_decode_jwt(token)
+                    token_cache.set(token, payload)
+                check_permissions(permission, payload)
+            _request_ctx_stack.top.current_user = payload
+            rate_limiter.check(request.endpoint, client_key())
             return f(payload, *args, **kwargs)
 
+        # routes without it are rate limited before the view, see `setup_rate_limit`
+        wrapper.requires_auth = True
         return wrapper
 
     return requires_auth_decorator
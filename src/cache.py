@@ -0,0 +1,126 @@
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache:
+    """In-process LRU cache, every entry expires `ttl` seconds after it was set"""
+
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ResourceCache:
+    """Read-through cache in front of a storage `backend`.
+
+    `backend` is anything with `get(key)`, `set(key, value)`, `delete(key)` and
+    `clear()`, e.g. an `LRUCache` or a client of a shared store. Without a backend
+    every lookup goes straight to the loader.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_load(self, key, load, fill=True):
+        """Returns cached value of `key`, calls `load()` and caches its result on a miss.
+        None is never cached, so missing rows are looked up every time, and neither is
+        anything with `fill` off, e.g. rows read from a replica that may be lagging
+        """
+        if self.backend is None:
+            return load()
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = load()
+        if value is not None and fill:
+            self.backend.set(key, value)
+        return value
+
+    async def get_or_load_async(self, key, load, fill=True):
+        """`get_or_load` with a coroutine function `load`"""
+        if self.backend is None:
+            return await load()
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = await load()
+        if value is not None and fill:
+            self.backend.set(key, value)
+        return value
+
+    def delete(self, *keys):
+        if self.backend is None:
+            return
+        for key in keys:
+            self.backend.delete(key)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self.backend is not None,
+            'size': len(self.backend) if isinstance(self.backend, LRUCache) else None,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else None,
+        }
+
+
+resource_cache = ResourceCache()
+
+
+def setup_cache(size=None, ttl=None, backend=None):
+    """Turns on the resource cache, an in-process LRU unless a shared `backend` is given.
+    `size` and `ttl` default to `CACHE_SIZE` and `CACHE_TTL` when called, `size` 0 keeps it disabled
+    """
+    if size is None:
+        size = int(os.environ.get('CACHE_SIZE', 0))
+    if ttl is None:
+        ttl = float(os.environ.get('CACHE_TTL', 30))
+    if backend is None and size > 0:
+        backend = LRUCache(size, ttl)
+    resource_cache.backend = backend
+    resource_cache.clear()
@@ -0,0 +1,133 @@
+"""Negotiated gzip and brotli compression of responses.
+
+Bodies under `COMPRESS_MIN_SIZE` bytes go out as they are, streamed bodies are compressed
+as they are generated. Compressed bodies of responses with an ETag are kept in
+`compressed_cache` by a digest of the uncompressed body, so a page requested again
+isn't compressed again and a changed body never gets an old compressed one.
+"""
+import hashlib
+import os
+import zlib
+
+from flask import request
+
+from .cache import LRUCache, ResourceCache
+from .metrics import span
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'text/plain', 'text/html', 'text/csv')
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 4))
+
+
+class GzipCompressor:
+    def __init__(self):
+        # wbits 31 writes a gzip header, without the mtime the gzip module puts in
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+class BrotliCompressor:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+# in order of preference, when the client accepts several equally
+COMPRESSORS = {'gzip': GzipCompressor}
+if brotli is not None:
+    COMPRESSORS = {'br': BrotliCompressor, **COMPRESSORS}
+ENCODINGS = tuple(e for e in os.environ.get('COMPRESS_ENCODINGS', ','.join(COMPRESSORS)).split(',') if e)
+
+# compressed bodies by encoding and digest of the uncompressed body
+compressed_cache = ResourceCache(LRUCache(
+    maxsize=int(os.environ.get('COMPRESS_CACHE_SIZE', 256)),
+    ttl=float(os.environ.get('COMPRESS_CACHE_TTL', 30)),
+))
+
+
+def negotiate(req=request):
+    """Best of `ENCODINGS` the client accepts, None to send the body as it is"""
+    if not ENCODINGS:
+        return None
+    return req.accept_encodings.best_match(ENCODINGS)
+
+
+def compress(data, encoding):
+    compressor = COMPRESSORS[encoding]()
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_body(data, encoding, cache=False):
+    """`data` compressed with `encoding`, through `compressed_cache` if `cache`,
+    which callers pass for bodies likely to be sent again, e.g. those with an ETag
+    """
+    with span('compress'):
+        if not cache:
+            return compress(data, encoding)
+        key = f'{encoding}:{hashlib.blake2b(data, digest_size=16).hexdigest()}'
+        return compressed_cache.get_or_load(key, lambda: compress(data, encoding))
+
+
+def compress_stream(chunks, encoding):
+    """Compresses an iterable of bytes as it goes, closes it when done like a WSGI server would"""
+    compressor = COMPRESSORS[encoding]()
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def setup_compression(app, min_size=COMPRESS_MIN_SIZE):
+    """Compresses the responses of `app` with the best encoding the client accepts.
+    Responses carrying an ETag get a weak one, as their bytes differ by encoding
+    """
+    if not ENCODINGS:
+        return
+    @app.after_request
+    def compress_response(response):
+        if (
+            response.mimetype not in COMPRESSIBLE
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers
+            or response.direct_passthrough
+        ):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate()
+        if encoding is None or request.method == 'HEAD':
+            return response
+        etag, weak = response.get_etag()
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < min_size:
+                return response
+            response.set_data(compress_body(data, encoding, cache=etag is not None))
+        response.headers['Content-Encoding'] = encoding
+        if etag is not None and not weak:
+            response.set_etag(etag, weak=True)
+        return response
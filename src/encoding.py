@@ -0,0 +1,40 @@
+import json
+import os
+from datetime import date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f'{value!r} is not JSON serializable')
+
+
+def stdlib_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'), default=_default).encode()
+
+
+def orjson_dumps(obj):
+    return orjson.dumps(obj)
+
+
+ENCODERS = {'json': stdlib_dumps}
+if orjson is not None:
+    ENCODERS['orjson'] = orjson_dumps
+
+dumps = stdlib_dumps
+
+
+def set_encoder(encoder):
+    """Sets the encoder used by `dumps`, either a name from `ENCODERS`
+    or a callable turning an object into json bytes
+    """
+    global dumps
+    dumps = ENCODERS[encoder] if isinstance(encoder, str) else encoder
+
+
+set_encoder(os.environ.get('JSON_ENCODER', 'orjson' if orjson is not None else 'json'))
@@ -0,0 +1,158 @@
+"""Group commit of single-row inserts.
+
+With `GROUP_COMMIT` on, `DbMethods.insert` hands its row to a background writer
+instead of committing a transaction of its own. The writer collects the rows arriving
+within `GROUP_COMMIT_WINDOW` seconds of the first one, up to `GROUP_COMMIT_MAX_BATCH`,
+and inserts them in one transaction, so a burst of inserts waits for one commit, and
+one fsync, rather than one each. Every insert still gets its own id, or its own error.
+"""
+import os
+import queue
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from sys import exc_info
+from threading import Lock, Thread
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from .metrics import Histogram
+
+GROUP_COMMIT = os.environ.get('GROUP_COMMIT', '') in ('1', 'true', 'yes')
+GROUP_COMMIT_WINDOW = float(os.environ.get('GROUP_COMMIT_WINDOW', 0.002))
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', 500))
+# rows per committed transaction
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class GroupCommitter:
+    """Background writer inserting the rows of concurrent `insert()` calls in shared transactions.
+    Off until `setup_group_commit` binds it to an app and its `db`
+    """
+
+    def __init__(self, window=GROUP_COMMIT_WINDOW, max_batch=GROUP_COMMIT_MAX_BATCH):
+        self.window = window
+        self.max_batch = max_batch
+        self.app = None
+        self.db = None
+        self.batches = Histogram(BATCH_BUCKETS)
+        self.retries = 0
+        self.after_fork()
+
+    @property
+    def enabled(self):
+        return self.app is not None
+
+    def insert(self, model, values):
+        """Inserts `values` into the table of `model` with the next batch, blocks until it
+        is committed and returns the new row's id. Raises the SQLAlchemyError of the row
+        """
+        future = Future()
+        self.start()
+        self._queue.put((model, values, future))
+        return future.result()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='group-commit', daemon=True)
+                self._thread.start()
+
+    def after_fork(self):
+        """Resets the queue and the writer thread, neither of which a forked child can use"""
+        self._queue = queue.Queue()
+        self._lock = Lock()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self.write(batch)
+
+    def write(self, batch):
+        """Inserts `batch` of (model, values, future) in one transaction. If it fails, retries it
+        with a savepoint per row, so only the rows at fault fail. Futures resolve after the commit,
+        any other failure, even to set up the app context, fails all of them
+        """
+        try:
+            with self.app.app_context():
+                session = self.db.session
+                try:
+                    try:
+                        ids = self._insert_all(session, batch)
+                    except SQLAlchemyError:
+                        session.rollback()
+                        self.retries += 1
+                        ids = self._insert_each(session, batch)
+                    session.commit()
+                except Exception:  # noqa
+                    session.rollback()
+                    raise
+                finally:
+                    session.remove()
+        except Exception as e:  # noqa
+            print(exc_info())
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        self.batches.observe(len(batch))
+        for (_, _, future), pk in zip(batch, ids):
+            if isinstance(pk, Exception):
+                future.set_exception(pk)
+            else:
+                future.set_result(pk)
+
+    @staticmethod
+    def _insert_all(session, batch):
+        rows = defaultdict(list)
+        for model, values, _ in batch:
+            rows[model].append(dict(values))
+        for model, model_rows in rows.items():
+            session.bulk_insert_mappings(model, model_rows, return_defaults=True)
+        # return_defaults sets the id of each row, rows of a model are in the order of the batch
+        ids = {model: iter(model_rows) for model, model_rows in rows.items()}
+        return [next(ids[model])['id'] for model, _, _ in batch]
+
+    @staticmethod
+    def _insert_each(session, batch):
+        ids = []
+        for model, values, _ in batch:
+            row = dict(values)
+            try:
+                with session.begin_nested():
+                    session.bulk_insert_mappings(model, [row], return_defaults=True)
+                ids.append(row['id'])
+            except SQLAlchemyError as e:
+                ids.append(e)
+        return ids
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'window_seconds': self.window,
+            'max_batch': self.max_batch,
+            'batch_rows': self.batches.snapshot(),
+            'retries': self.retries,
+        }
+
+
+group_committer = GroupCommitter()
+os.register_at_fork(after_in_child=group_committer.after_fork)
+
+
+def setup_group_commit(app, db, enabled=GROUP_COMMIT, window=GROUP_COMMIT_WINDOW, max_batch=GROUP_COMMIT_MAX_BATCH):
+    """Turns group commit of `DbMethods.insert` on for the inserts of `app`, written through `db`"""
+    group_committer.window = window
+    group_committer.max_batch = max_batch
+    group_committer.app = app if enabled else None
+    group_committer.db = db
+    group_committer.batches = Histogram(BATCH_BUCKETS)
+    group_committer.retries = 0
@@ -0,0 +1,119 @@
+import json
+import logging
+import time
+from pathlib import Path
+from threading import Lock, Thread, Event
+from urllib.request import urlopen
+
+from jose import jwk
+from jose.constants import ALGORITHMS
+
+logger = logging.getLogger(__name__)
+
+
+class KeyStore:
+    """Public keys of a JWKS, parsed once into key objects and indexed by `kid`.
+
+    Keys are loaded lazily on the first lookup, from `file` if it exists and
+    from `url` otherwise. An unknown `kid` triggers a refetch from `url`, at most
+    once per `min_refresh_interval` seconds, and `start()` refreshes the keys
+    every `refresh_interval` seconds in a background thread. `url` may be a function
+    returning it, called on first use.
+    """
+
+    def __init__(self, url=None, file=None, refresh_interval=3600, min_refresh_interval=60):
+        self._url = url
+        self.file = file
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.fetches = 0
+        self._keys = None
+        self._last_fetch = 0.
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+
+    @property
+    def url(self):
+        if callable(self._url):
+            self._url = self._url()
+        return self._url
+
+    def load(self, jwks):
+        """Replaces current keys with the signing keys of `jwks`"""
+        keys = {}
+        for key in jwks['keys']:
+            if key.get('kty') != 'RSA' or key.get('use', 'sig') != 'sig':
+                continue
+            keys[key['kid']] = jwk.construct(key, ALGORITHMS.RS256)
+        self._keys = keys
+
+    def _read(self):
+        if self.file and Path(self.file).is_file():
+            with open(self.file, 'rb') as f:
+                return json.load(f)
+        return self._fetch()
+
+    def _fetch(self):
+        if not self.url:
+            raise LookupError('JWKS is neither in a local file nor has a url to fetch from')
+        self.fetches += 1
+        content = urlopen(self.url, timeout=10).read()
+        if self.file:
+            with open(self.file, 'wb') as f:
+                f.write(content)
+        return json.loads(content)
+
+    def refresh(self):
+        """Refetches keys from `url`, rate limited by `min_refresh_interval`.
+        Returns True if the keys were refreshed
+        """
+        with self._lock:
+            if not self.url or time.monotonic() - self._last_fetch < self.min_refresh_interval:
+                return False
+            self._last_fetch = time.monotonic()
+            try:
+                self.load(self._fetch())
+            except Exception:  # noqa
+                logger.exception('JWKS refresh failed')
+                return False
+            return True
+
+    def keys(self):
+        if self._keys is None:
+            with self._lock:
+                if self._keys is None:
+                    self.load(self._read())
+        return self._keys
+
+    def get(self, kid):
+        """Returns the public key with the given `kid` or None"""
+        key = self.keys().get(kid)
+        if key is None and self.refresh():
+            key = self._keys.get(kid)
+        return key
+
+    def start(self):
+        """Starts refreshing keys in a background thread, if there is a url to refresh from"""
+        if self._thread is not None or not self.url or self.refresh_interval <= 0:
+            return
+        self._stop = Event()
+        self._thread = Thread(target=self._run, args=(self._stop,), name='jwks-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+
+    def after_fork(self):
+        """Resets what a forked child inherits but can't use: the refresh thread,
+        which doesn't survive the fork, and the lock it may have held at the time.
+        The next `start()` starts a thread of the child's own
+        """
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+
+    def _run(self, stop):
+        while not stop.wait(self.refresh_interval):
+            self.refresh()
@@ -0,0 +1,174 @@
+import os
+from bisect import bisect_left
+from contextlib import nullcontext
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+METRICS_ENABLED = os.environ.get('METRICS', '') in ('1', 'true', 'yes')
+# seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """Counts of observed values per bucket, `bounds` are the inclusive upper bounds
+    of the buckets in ascending order, values above the last one go to +Inf
+    """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        """Cumulative counts keyed by upper bound, the way Prometheus reports buckets"""
+        with self._lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        buckets, running = {}, 0
+        for bound, n in zip((*map(str, self.bounds), '+Inf'), counts):
+            running += n
+            buckets[bound] = running
+        return {'buckets': buckets, 'count': count, 'sum': total}
+
+
+class Registry:
+    """Latency histograms of requests by method, route and status, and of their phases"""
+
+    families = {
+        'http_request_duration_seconds': 'Time to handle a request, until the response headers',
+        'http_request_phase_seconds': 'Time a request spent in a phase: auth, query, format, encode or compress',
+    }
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self._histograms = {family: {} for family in self.families}
+        self._lock = Lock()
+
+    def histogram(self, family, labels):
+        histograms = self._histograms[family]
+        histogram = histograms.get(labels)
+        if histogram is None:
+            with self._lock:
+                histogram = histograms.setdefault(labels, Histogram(self.bounds))
+        return histogram
+
+    def observe(self, method, route, status, duration, spans):
+        labels = (('method', method), ('route', route))
+        self.histogram('http_request_duration_seconds', (*labels, ('status', str(status)))).observe(duration)
+        for phase, seconds in spans.items():
+            self.histogram('http_request_phase_seconds', (*labels, ('phase', phase))).observe(seconds)
+
+    def clear(self):
+        with self._lock:
+            for histograms in self._histograms.values():
+                histograms.clear()
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for family, description in self.families.items():
+            lines += [f'# HELP {family} {description}', f'# TYPE {family} histogram']
+            for labels, histogram in sorted(self._histograms[family].items()):
+                snapshot = histogram.snapshot()
+                text = ','.join(f'{k}="{v}"' for k, v in labels)
+                lines += [f'{family}_bucket{{{text},le="{le}"}} {n}' for le, n in snapshot['buckets'].items()]
+                lines.append(f'{family}_sum{{{text}}} {snapshot["sum"]}')
+                lines.append(f'{family}_count{{{text}}} {snapshot["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class RequestTimer:
+    """Time spent by one request in each phase"""
+
+    __slots__ = ('start', 'spans')
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.spans = {}
+
+    def add(self, phase, seconds):
+        self.spans[phase] = self.spans.get(phase, 0) + seconds
+
+    def elapsed(self):
+        return perf_counter() - self.start
+
+    def server_timing(self, total):
+        """Value of the Server-Timing header, durations in milliseconds"""
+        metrics = (*self.spans.items(), ('total', total))
+        return ', '.join(f'{phase};dur={seconds * 1000:.2f}' for phase, seconds in metrics)
+
+
+class Span:
+    __slots__ = ('timer', 'phase', 'start')
+
+    def __init__(self, timer, phase):
+        self.timer = timer
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *_exc):
+        self.timer.add(self.phase, perf_counter() - self.start)
+
+
+# timer of the request being handled, None if metrics are off
+current_timer = ContextVar('current_timer', default=None)
+_no_span = nullcontext()
+
+
+def span(phase):
+    """Context manager adding the time spent in it to `phase` of the current request"""
+    timer = current_timer.get()
+    return _no_span if timer is None else Span(timer, phase)
+
+
+def before_cursor_execute(conn, _cursor, _statement, _parameters, _context, _executemany):
+    if current_timer.get() is not None and not conn.dialect.is_async:
+        conn.info.setdefault('query_start', []).append(perf_counter())
+
+
+def after_cursor_execute(conn, _cursor, _statement, _parameters, _context, _executemany):
+    timer = current_timer.get()
+    if timer is not None and conn.info.get('query_start'):
+        timer.add('query', perf_counter() - conn.info['query_start'].pop())
+
+
+def setup_metrics(app):
+    """Times every request of `app` into `registry` and adds Server-Timing headers to responses.
+    Database time is measured by engine events, which aren't listened to until this is called
+    """
+    if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    @app.before_request
+    def start_timer():
+        current_timer.set(RequestTimer())
+    @app.after_request
+    def stop_timer(response):
+        timer = current_timer.get()
+        if timer is not None:
+            total = timer.elapsed()
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            registry.observe(request.method, route, response.status_code, total, timer.spans)
+            response.headers['Server-Timing'] = timer.server_timing(total)
+        return response
+    @app.teardown_request
+    def reset_timer(_exc):
+        current_timer.set(None)
@@ -1,40 +1,226 @@
 import os
-from datetime import date
+from datetime import date, datetime
 
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, String, Integer, ForeignKey, Date
-from sqlalchemy.orm import relationship
+from sqlalchemy import DDL, Column, String, Integer, ForeignKey, Date, DateTime, Index, cast as sql_cast, event, extract, func, inspect
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import make_transient_to_detached, relationship, selectinload
+from sqlalchemy.sql.expression import FunctionElement
 
-db = SQLAlchemy()
+from .cache import resource_cache
+from .groupcommit import group_committer
+from .pool import pool_options
+from .routing import RoutingSQLAlchemy, reads_from_primary, remember_writer
+
+db = RoutingSQLAlchemy()
 default_db_path = 'sqlite:///db.sqlite3'
+# width of the age buckets of actor stats, in years
+AGE_BUCKET = 10
+# see `Actor.gender_str`
+GENDERS = (0, 1)
 
-def setup_db(app, database_path=os.environ.get('DATABASE', default_db_path)):
+def setup_db(app, database_path=None, replica_paths=None):
+    """Configures `db` for `app`, by default on `DATABASE` and `DATABASE_REPLICAS`.
+    Nothing connects until the first query
+    """
+    if database_path is None:
+        database_path = os.environ.get('DATABASE', default_db_path)
+    if replica_paths is None:
+        replica_paths = [path for path in os.environ.get('DATABASE_REPLICAS', '').split(',') if path]
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = pool_options(database_path)
+    app.config["SQLALCHEMY_BINDS"] = {f'replica{i}': path for i, path in enumerate(replica_paths)}
+    app.config["DATABASE_REPLICAS"] = tuple(app.config["SQLALCHEMY_BINDS"])
+    app.config["DATABASE_REPLICA_STRATEGY"] = os.environ.get('DATABASE_REPLICA_STRATEGY', 'round-robin')
     db.app = app
     db.init_app(app)
     # db.create_all()
 
 class DbMethods:
     def insert(self):
-        db.session.add(self)
-        db.session.commit()
+        if group_committer.enabled:
+            # committed along with concurrent inserts, by another session, so `self` comes back
+            # detached: its id and the values it was given are loaded, the rest is expired
+            state = inspect(self)
+            values = {attr.key: state.dict[attr.key] for attr in state.mapper.column_attrs if attr.key in state.dict}
+            self.id = group_committer.insert(type(self), values)
+            make_transient_to_detached(self)
+            remember_writer(db.session)
+        else:
+            db.session.add(self)
+            db.session.commit()
+        resource_cache.delete(self.cache_key(*inspect(self).identity), self.stats_key())
         return self
 
     def update(self):  # noqa
+        # bumped in SQL, a plain counter rather than the mapper's version_id_col,
+        # so concurrent writes of a row don't fail each other, the last one wins
+        self.version = type(self).version + 1
         db.session.commit()
+        resource_cache.delete(self.cache_key(*inspect(self).identity), self.stats_key())
         return self
 
     def delete(self):
         db.session.delete(self)
         db.session.commit()
+        resource_cache.delete(self.cache_key(*inspect(self).identity), self.stats_key())
         return self
 
+    @classmethod
+    def cache_key(cls, pk):
+        # instances pass their identity, reading `self.id` after commit would reload the row
+        return f'{cls.__tablename__}:{pk}'
+
+    @classmethod
+    def stats_key(cls):
+        return f'{cls.__tablename__}:stats'
+
+    @classmethod
+    def get_stats(cls):
+        """`stats()` through the resource cache, every write of the table invalidates it"""
+        return resource_cache.get_or_load(cls.stats_key(), cls.stats)
+
+    @property
+    def etag(self):
+        return make_etag(self.version, self.updated_at)
+
+    @classmethod
+    def get_version(cls, pk):
+        """(etag, updated_at) of the row `pk` without loading the row itself, None if there is no such row"""
+        row = db.session.query(cls.version, cls.updated_at).filter(cls.id == pk).first()
+        return row and (make_etag(*row), row.updated_at)
+
+    @classmethod
+    def get_formatted(cls, pk):
+        """(format(), etag, updated_at) of the row `pk` through the resource cache,
+        None if there is no such row. Only rows read from the primary are cached
+        """
+        def load():
+            obj = cls.query.get(pk)
+            return obj and (obj.format(), obj.etag, obj.updated_at)
+        return resource_cache.get_or_load(cls.cache_key(pk), load, fill=reads_from_primary())
+
+    @classmethod
+    def get_partial(cls, pk, fields):
+        """Like `get_formatted`, but selects only `fields` of the row and bypasses the cache"""
+        row = (
+            db.session.query(*(getattr(cls, f) for f in fields), cls.version, cls.updated_at)
+            .filter(cls.id == pk)
+            .first()
+        )
+        return row and (cls.format_row(row, fields), make_etag(row.version, row.updated_at), row.updated_at)
+
+    @classmethod
+    def format_row(cls, row, fields):
+        """`format()` of a plain row whose first columns are `fields`, skips ORM hydration"""
+        item = dict(zip(fields, row))
+        for f in cls.date_fields:
+            if item.get(f) is not None:
+                item[f] = item[f].isoformat()
+        return item
+
+    @classmethod
+    def load_related(cls, ids, name):
+        """Objects of the `name` relationship of the rows `ids` as {id: [obj, ...]}.
+        All of it is loaded by two queries, whatever the number of ids
+        """
+        objs = cls.query.options(selectinload(getattr(cls, name))).filter(cls.id.in_(ids)).all()
+        return {obj.id: getattr(obj, name) for obj in objs}
+
+    @classmethod
+    def fields_from_json(cls, data, partial=False):
+        """Validated column values from request json, raises ValueError if invalid.
+        With `partial` only the fields `data` has are validated and returned
+        """
+        if not isinstance(data, dict):
+            raise ValueError(data)
+        return {
+            field: parse(data.get(field))
+            for field, parse in cls.json_parsers.items()
+            if not partial or field in data
+        }
+
+    @classmethod
+    def version_bump(cls):
+        """Values to SET along with bulk UPDATEs, which bypass `update()`"""
+        return {'version': cls.version + 1, 'updated_at': datetime.utcnow()}
+
+
+class UtcNow(FunctionElement):
+    """Current UTC time, as `updated_at` is stored. `now()` is local time on postgres"""
+    type = DateTime()
+    inherit_cache = True
+
+
+@compiles(UtcNow)
+def compile_utc_now(element, compiler, **kw):
+    return 'CURRENT_TIMESTAMP'
+
+
+@compiles(UtcNow, 'postgresql')
+def compile_utc_now_postgresql(element, compiler, **kw):
+    return "timezone('utc', now())"
+
+
+def str_parser(max_length=None):
+    """Parser of request json values of string columns, non-empty and at most `max_length` long"""
+    def parse(value):
+        if not isinstance(value, str) or not value or max_length is not None and len(value) > max_length:
+            raise ValueError(value)
+        return value
+    return parse
+
+
+def parse_positive_int(value):
+    # bool is an int too
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+        raise ValueError(value)
+    return value
+
+
+def parse_gender(value):
+    if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value not in GENDERS):
+        raise ValueError(value)
+    return value
+
+
+def parse_date(value):
+    if not isinstance(value, str):
+        raise ValueError(value)
+    return date.fromisoformat(value)
+
+
+def make_etag(version, updated_at):
+    return f'{version}-{updated_at:%Y%m%d%H%M%S%f}'
+
+
+# the primary key (movie_id, actor_id) indexes movie_id
+cast = db.Table(
+    'movie_actor',
+    Column('movie_id', Integer, ForeignKey('movie.id', ondelete='CASCADE'), primary_key=True),
+    Column('actor_id', Integer, ForeignKey('actor.id', ondelete='CASCADE'), primary_key=True),
+    Index('ix_movie_actor_actor_id', 'actor_id'),
+)
+
 
 class Movie(DbMethods, db.Model):
+    json_fields = ('id', 'title', 'release_date')
+    date_fields = ('release_date',)
+    # parsers of the writable fields in request json, see `fields_from_json`
+    json_parsers = {'title': str_parser(80), 'release_date': parse_date}
     id = Column(Integer, primary_key=True)
     title = Column(String(80))
     release_date = Column(Date)
+    version = Column(Integer, nullable=False, server_default='1')
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow,
+                        server_default=UtcNow())
+    actors = relationship('Actor', secondary=cast, back_populates='movies', order_by='Actor.id')
+    __table_args__ = (
+        # (column, id) indexes serve keyset pagination when sorted by the column
+        Index('ix_movie_release_date_id', 'release_date', 'id'),
+        Index('ix_movie_title_id', 'title', 'id'),
+        Index('ix_movie_title_pattern', 'title', postgresql_ops={'title': 'text_pattern_ops'}),
+    )
 
     def __init__(self, title: str, release_date: date): # noqa
         self.title = title
@@ -68,12 +254,42 @@ class Movie(DbMethods, db.Model):
             release_date=date(2022, 5, 1).isoformat(),
         )
 
+    @classmethod
+    def stats(cls):
+        """Number of movies, in total and per release year, counted by a single GROUP BY"""
+        year = sql_cast(extract('year', cls.release_date), Integer)
+        rows = db.session.query(year, func.count()).group_by(year).order_by(year).all()
+        return dict(
+            total=sum(count for _, count in rows),
+            by_year=[dict(year=y, count=count) for y, count in rows],
+        )
+
+    @classmethod
+    def example_stats(cls):
+        return dict(
+            total=3,
+            by_year=[dict(year=2021, count=1), dict(year=2022, count=2)],
+        )
+
 
 class Actor(DbMethods, db.Model):
+    json_fields = ('id', 'name', 'age', 'gender')
+    date_fields = ()
+    json_parsers = {'name': str_parser(), 'age': parse_positive_int, 'gender': parse_gender}
     id = Column(Integer, primary_key=True)
     name = Column(String)
     age = Column(Integer)
     gender = Column(Integer)
+    version = Column(Integer, nullable=False, server_default='1')
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow,
+                        server_default=UtcNow())
+    movies = relationship('Movie', secondary=cast, back_populates='actors', order_by='Movie.id')
+    __table_args__ = (
+        Index('ix_actor_age_id', 'age', 'id'),
+        Index('ix_actor_gender_age', 'gender', 'age'),
+        Index('ix_actor_name_id', 'name', 'id'),
+        Index('ix_actor_name_pattern', 'name', postgresql_ops={'name': 'text_pattern_ops'}),
+    )
 
     def __init__(self, name: str, age: int, gender: int): # noqa
         self.name = name
@@ -114,3 +330,73 @@ class Actor(DbMethods, db.Model):
             age=42,
             gender=0,
         )
+
+    @classmethod
+    def stats(cls):
+        """Number of actors, in total, by gender, by `AGE_BUCKET` years of age and by both,
+        counted by a single GROUP BY of both
+        """
+        # integer division, on postgres and sqlite alike
+        bucket = cls.age / AGE_BUCKET * AGE_BUCKET
+        rows = (
+            db.session.query(cls.gender, bucket, func.count())
+            .group_by(cls.gender, bucket)
+            .order_by(cls.gender, bucket)
+            .all()
+        )
+        by_gender = {}
+        by_age = {}
+        for gender, age, count in rows:
+            by_gender[gender] = by_gender.get(gender, 0) + count
+            by_age[age] = by_age.get(age, 0) + count
+        return dict(
+            total=sum(by_gender.values()),
+            by_gender=[dict(gender=g, count=count) for g, count in by_gender.items()],
+            by_age=[
+                dict(age_from=a, age_to=a if a is None else a + AGE_BUCKET - 1, count=count)
+                for a, count in sorted(by_age.items(), key=lambda item: (item[0] is None, item[0] or 0))
+            ],
+            by_gender_and_age=[dict(gender=g, age_from=a, count=count) for g, a, count in rows],
+        )
+
+    @classmethod
+    def example_stats(cls):
+        return dict(
+            total=3,
+            by_gender=[dict(gender=0, count=2), dict(gender=1, count=1)],
+            by_age=[dict(age_from=40, age_to=49, count=3)],
+            by_gender_and_age=[dict(gender=0, age_from=40, count=2), dict(gender=1, age_from=40, count=1)],
+        )
+
+
+def search_index(model, column):
+    """Full-text index of `column`, created and dropped along with the table of `model`.
+    On postgres a GIN index of its tsvector, on sqlite an FTS5 table `<table>_search`
+    kept in sync by triggers
+    """
+    table = model.__tablename__
+    fts = f'{table}_search'
+    statements = {
+        'postgresql': [
+            f"CREATE INDEX ix_{table}_{column}_search ON {table} USING gin (to_tsvector('simple', {column}))",
+        ],
+        'sqlite': [
+            f"CREATE VIRTUAL TABLE {fts} USING fts5({column}, content='{table}', content_rowid='id')",
+            f"CREATE TRIGGER {fts}_insert AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column}); END",
+            f"CREATE TRIGGER {fts}_delete AFTER DELETE ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column}); END",
+            f"CREATE TRIGGER {fts}_update AFTER UPDATE OF {column} ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column}); "
+            f"INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column}); END",
+        ],
+    }
+    for dialect, ddl in statements.items():
+        for statement in ddl:
+            event.listen(model.__table__, 'after_create', DDL(statement).execute_if(dialect=dialect))
+    # the triggers go with the table, the FTS5 table doesn't
+    event.listen(model.__table__, 'before_drop', DDL(f'DROP TABLE IF EXISTS {fts}').execute_if(dialect='sqlite'))
+
+
+search_index(Actor, 'name')
+search_index(Movie, 'title')
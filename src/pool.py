@@ -0,0 +1,81 @@
+import os
+import time
+from weakref import WeakSet
+
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+from .metrics import Histogram
+
+# seconds
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+# engines of the process, see `dispose_engines`
+engines = WeakSet()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool recording how long each checkout waited for a connection,
+    including the time to open a new one and the pre-ping
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_times = Histogram(WAIT_BUCKETS)
+        self.timeouts = 0
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self.wait_times.observe(time.perf_counter() - start)
+
+
+def pool_options(database_path):
+    """Engine options of the connection pool, from the environment.
+    sqlite keeps the pool SQLAlchemy picks for it
+    """
+    if database_path.startswith('sqlite'):
+        return {}
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', -1)),
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '') in ('1', 'true', 'yes'),
+    }
+
+
+def pool_stats(pool):
+    stats = {'class': type(pool).__name__, 'status': pool.status()}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'max_overflow': pool._max_overflow,
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0),
+        })
+    if isinstance(pool, TimedQueuePool):
+        stats.update({
+            'timeouts': pool.timeouts,
+            'wait_seconds': pool.wait_times.snapshot(),
+        })
+    return stats
+
+
+def dispose_engines():
+    """Drops the pooled connections a forked child inherited from its parent, e.g. a gunicorn
+    worker forked after `--preload`. They are left open, as they are still the parent's,
+    the child opens connections of its own on first use
+    """
+    for engine in list(engines):
+        engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=dispose_engines)
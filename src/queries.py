@@ -0,0 +1,101 @@
+import os
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+QUERY_WARN_THRESHOLD = int(os.environ.get('QUERY_WARN_THRESHOLD', 10))
+
+
+class QueryRecorder:
+    """SQL statements executed while recording and the time spent on them.
+    Statements are added to the enclosing recorder too, so recorders nest
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.statements = []
+        self.duration = 0.0
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def add(self, statement, seconds):
+        recorder = self
+        while recorder is not None:
+            recorder.statements.append(statement)
+            recorder.duration += seconds
+            recorder = recorder.parent
+
+    def most_common(self):
+        """(statement, times) of the most repeated statement, the usual sign of an N+1"""
+        return Counter(self.statements).most_common(1)[0] if self.statements else (None, 0)
+
+
+current_recorder = ContextVar('current_recorder', default=None)
+
+
+def before_cursor_execute(conn, _cursor, _statement, _parameters, _context, _executemany):
+    if current_recorder.get() is not None:
+        conn.info.setdefault('recorder_start', []).append(perf_counter())
+
+
+def after_cursor_execute(conn, _cursor, statement, _parameters, _context, _executemany):
+    recorder = current_recorder.get()
+    if recorder is not None and conn.info.get('recorder_start'):
+        recorder.add(statement, perf_counter() - conn.info['recorder_start'].pop())
+
+
+def listen():
+    if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+
+@contextmanager
+def record_queries():
+    """Records the statements executed within, e.g. to assert how many queries a request makes:
+
+        with record_queries() as queries:
+            client.get('/movies')
+        assert queries.count <= 2
+    """
+    listen()
+    recorder = QueryRecorder(current_recorder.get())
+    token = current_recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        current_recorder.reset(token)
+
+
+def setup_query_recorder(app, threshold=QUERY_WARN_THRESHOLD):
+    """Counts the statements of every request of `app`, logs a warning
+    when a request issues more than `threshold` of them. 0 turns it off
+    """
+    if threshold <= 0:
+        return
+    listen()
+    @app.before_request
+    def start_recording():
+        g.query_recorder_token = current_recorder.set(QueryRecorder(current_recorder.get()))
+    @app.after_request
+    def check_recording(response):
+        recorder = current_recorder.get()
+        if recorder is not None and recorder.count > threshold:
+            statement, times = recorder.most_common()
+            app.logger.warning(
+                '%s %s issued %d queries in %.1fms, %d times: %s',
+                request.method, request.path, recorder.count, recorder.duration * 1000, times, statement,
+            )
+        return response
+    @app.teardown_request
+    def stop_recording(_exc):
+        token = g.pop('query_recorder_token', None)
+        if token is not None:
+            current_recorder.reset(token)
@@ -0,0 +1,151 @@
+"""Token-bucket rate limiting of requests.
+
+A client is the `sub` of its verified token on routes that require auth, its address on
+public ones. Every route with a budget of its own has a bucket per client, all the other
+routes share the client's bucket of the default budget. A budget `N/S` holds up to N
+requests and refills at N per S seconds, so a client can burst N requests at once and
+then keeps going at the refill rate.
+
+Verifying a token's signature is the costly part of a request, and a client sending bad
+tokens never gets a `sub`, so verifications are counted per address beforehand too.
+"""
+import math
+import os
+import time
+from collections import OrderedDict, namedtuple
+from threading import Lock
+
+from flask import request
+from werkzeug.exceptions import TooManyRequests
+
+from .routing import client_key
+
+RATE_LIMIT = os.environ.get('RATE_LIMIT', '')
+RATE_LIMITS = os.environ.get('RATE_LIMITS', '')
+RATE_LIMIT_SHARDS = int(os.environ.get('RATE_LIMIT_SHARDS', 16))
+RATE_LIMIT_SIZE = int(os.environ.get('RATE_LIMIT_SIZE', 100_000))
+# budget name of token verifications, limited by the default budget unless given one
+VERIFY_ENDPOINT = 'verify_token'
+
+
+class Budget(namedtuple('Budget', 'requests seconds')):
+    @property
+    def rate(self):
+        return self.requests / self.seconds
+
+
+def parse_budget(budget):
+    """`Budget` of `N/S`, N requests per S seconds, raises ValueError if it isn't one"""
+    requests, seconds = budget.split('/')
+    budget = Budget(int(requests), float(seconds))
+    if budget.requests < 1 or budget.seconds <= 0:
+        raise ValueError(budget)
+    return budget
+
+
+def parse_budgets(budgets):
+    """{endpoint: `Budget`} of `endpoint=N/S,endpoint=N/S`"""
+    endpoints = (item.split('=') for item in budgets.split(',') if item.strip())
+    return {endpoint.strip(): parse_budget(budget) for endpoint, budget in endpoints}
+
+
+class MemoryStore:
+    """Token buckets in process memory, spread over `shards` independently locked LRUs
+    so requests of different clients rarely wait for each other. A bucket evicted
+    from a full shard starts over full, which only ever lets a client through
+    """
+
+    def __init__(self, shards=RATE_LIMIT_SHARDS, maxsize=RATE_LIMIT_SIZE):
+        self.shard_size = max(1, maxsize // shards)
+        self._shards = [(OrderedDict(), Lock()) for _ in range(shards)]
+
+    def take(self, key, rate, burst):
+        """Takes a token from the bucket of `key`, returns 0 if there was one,
+        otherwise seconds until there is
+        """
+        buckets, lock = self._shards[hash(key) % len(self._shards)]
+        now = time.monotonic()
+        with lock:
+            tokens, last = buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            buckets[key] = (tokens - 1 if wait == 0 else tokens, now)
+            buckets.move_to_end(key)
+            if len(buckets) > self.shard_size:
+                buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        for buckets, lock in self._shards:
+            with lock:
+                buckets.clear()
+
+    def __len__(self):
+        return sum(len(buckets) for buckets, _ in self._shards)
+
+
+class RateLimiter:
+    """Enforces the `default` budget and per endpoint `budgets` on clients.
+
+    `store` is anything with `take(key, rate, burst)` as `MemoryStore` has, e.g. a client
+    of a store shared by all workers doing the same arithmetic atomically. With neither
+    a default nor a budget every request goes through without touching the store.
+    """
+
+    def __init__(self, store=None, default=None, budgets=None):
+        self.store = store or MemoryStore()
+        self.default = default
+        self.budgets = budgets or {}
+        self.limited = 0
+
+    @property
+    def enabled(self):
+        return self.default is not None or bool(self.budgets)
+
+    def check(self, endpoint, client):
+        """Counts a request of `client` to `endpoint`, raises `TooManyRequests`
+        with the seconds to wait as `retry_after` if it's over budget
+        """
+        budget = self.budgets.get(endpoint)
+        if budget is None:
+            budget, endpoint = self.default, '*'
+            if budget is None:
+                return
+        self._take(f'{client}|{endpoint}', budget)
+
+    def check_verify(self, address):
+        """Counts a token verification of `address` ahead of it, raises `TooManyRequests`
+        if it's over the `verify_token` budget, or the default one
+        """
+        budget = self.budgets.get(VERIFY_ENDPOINT, self.default)
+        if budget is not None:
+            self._take(f'{address}|{VERIFY_ENDPOINT}', budget)
+
+    def _take(self, key, budget):
+        wait = self.store.take(key, budget.rate, budget.requests)
+        if wait:
+            self.limited += 1
+            raise TooManyRequests(retry_after=math.ceil(wait))
+
+
+rate_limiter = RateLimiter()
+
+
+def setup_rate_limit(app, default=RATE_LIMIT, budgets=RATE_LIMITS, store=None):
+    """Turns on rate limiting of every request to `app`, e.g. `default='600/60'` and
+    `budgets='get_actors=60/60'`. Empty `default` and `budgets` keep it off.
+    Routes that require auth are limited by `requires_auth` once the token is verified,
+    tokens it has to verify on the client address before that, the rest, including
+    unknown paths, right away on the client address
+    """
+    rate_limiter.store = store or MemoryStore()
+    rate_limiter.default = parse_budget(default) if default else None
+    rate_limiter.budgets = parse_budgets(budgets) if budgets else {}
+    rate_limiter.limited = 0
+    if not rate_limiter.enabled:
+        return
+    @app.before_request
+    def limit_public_routes():
+        view = app.view_functions.get(request.endpoint)
+        if not getattr(view, 'requires_auth', False):
+            rate_limiter.check(request.endpoint, client_key())
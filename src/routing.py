@@ -0,0 +1,132 @@
+import itertools
+import os
+import time
+
+from flask import current_app, g, request, has_app_context, has_request_context, _request_ctx_stack
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+
+from .cache import LRUCache
+from .pool import engines
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+READ_YOUR_WRITES_WINDOW = float(os.environ.get('READ_YOUR_WRITES_WINDOW', 5))
+# time of the client's last write, for the workers that didn't handle it
+WRITE_COOKIE = 'last_write'
+
+# clients that wrote recently, their reads go to the primary until the entry expires
+recent_writers = LRUCache(
+    maxsize=int(os.environ.get('READ_YOUR_WRITES_SIZE', 10000)),
+    ttl=READ_YOUR_WRITES_WINDOW,
+)
+
+
+def client_key():
+    """`sub` of the verified token if the route requires auth, client address otherwise"""
+    payload = getattr(_request_ctx_stack.top, 'current_user', None)
+    return payload and payload.get('sub') or request.remote_addr
+
+
+def wrote_recently(client, req=request):
+    """Whether `client` wrote within the window, as recorded by this worker or by the cookie
+    the worker that handled the write set. The cookie only ever sends the client's own reads
+    to the primary, so it isn't signed
+    """
+    if recent_writers.get(client) is not None:
+        return True
+    try:
+        return time.time() - float(req.cookies.get(WRITE_COOKIE, '')) < READ_YOUR_WRITES_WINDOW
+    except ValueError:
+        return False
+
+
+def reads_from_replica():
+    """Whether queries of the current request may go to a replica: it has to be
+    a read-only request of a client that didn't write within the window
+    """
+    return (
+        has_request_context()
+        and request.method in READ_METHODS
+        and not wrote_recently(client_key())
+    )
+
+
+def reads_from_primary():
+    """Whether queries of the current context all go to the primary, the only rows fresh
+    enough to cache: a replica may not have caught up with a write the cache was just cleared of
+    """
+    return not (has_app_context() and current_app.config.get('DATABASE_REPLICAS')) or not reads_from_replica()
+
+
+def set_write_cookie(response):
+    """`after_request` hook handing the time of a write back to the client, so whichever
+    worker serves its next reads sends them to the primary too
+    """
+    last_write = g.get('last_write')
+    if last_write is not None and current_app.config.get('DATABASE_REPLICAS'):
+        response.set_cookie(
+            WRITE_COOKIE, f'{last_write:.3f}', max_age=READ_YOUR_WRITES_WINDOW, httponly=True, samesite='Lax',
+        )
+    return response
+
+
+class RoutingSession(SignallingSession):
+    """Session sending queries of read-only requests to a replica, everything else,
+    including flushes, to the primary. Each session sticks to one replica until closed
+    """
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self.db = db
+        self._replica = None
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if not self._flushing and reads_from_replica():
+            if self._replica is None:
+                self._replica = self.db.replica_engine(self.app)
+            if self._replica is not None:
+                return self._replica
+        return super().get_bind(mapper, clause)
+
+    def close(self):
+        super().close()
+        self._replica = None
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def remember_writer(_session):
+    if has_request_context() and request.method not in READ_METHODS:
+        recent_writers.set(client_key(), True)
+        g.last_write = time.time()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy whose sessions read from the binds listed in the
+    `DATABASE_REPLICAS` config, picked round-robin or by least connections
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._counter = itertools.count()
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        # engines are created on first use, forked children dispose of them
+        engine = super().create_engine(sa_url, engine_opts)
+        engines.add(engine)
+        return engine
+
+    def replica_engine(self, app):
+        binds = app.config.get('DATABASE_REPLICAS')
+        if not binds:
+            return None
+        if app.config.get('DATABASE_REPLICA_STRATEGY') == 'least-connections':
+            return min((self.get_engine(app, bind) for bind in binds), key=checked_out)
+        return self.get_engine(app, binds[next(self._counter) % len(binds)])
+
+
+def checked_out(engine):
+    checkedout = getattr(engine.pool, 'checkedout', None)
+    return checkedout() if checkedout else 0
@@ -0,0 +1,95 @@
+"""Full-text search over actor names and movie titles.
+
+Runs on the indexes of `models.search_index`: the tsvector GIN indexes on postgres,
+the FTS5 tables on sqlite. Every word of the query matches words starting with it,
+so partial input like `tom han` finds "Tom Hanks".
+"""
+import json
+import re
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from sqlalchemy import Float, and_, cast, column, func, literal, literal_column, or_, select, table, text, tuple_, union_all
+
+from .models import Actor, Movie, db
+
+SEARCHABLE = {
+    'actor': (Actor, 'name'),
+    'movie': (Movie, 'title'),
+}
+re_term = re.compile(r'[^\W_]+')
+
+
+def search_terms(q):
+    """Lowercase words of a search query, anything else is dropped"""
+    return re_term.findall(q.lower())
+
+
+def postgres_hits(kind, terms):
+    """type, id, text and rank of the rows of `kind` matching all of `terms`"""
+    model, field = SEARCHABLE[kind]
+    searched = getattr(model, field)
+    # the same expression as the index, so the planner uses it
+    config = literal_column("'simple'")
+    vector = func.to_tsvector(config, searched)
+    query = func.to_tsquery(config, ' & '.join(f'{t}:*' for t in terms))
+    # whole words rank above words they are only the start of
+    words = func.to_tsquery(config, ' | '.join(terms))
+    # ts_rank is a float4, as float8 it survives the round trip through the cursor
+    rank = cast(func.ts_rank(vector, query) + func.ts_rank(vector, words), Float)
+    return (
+        select(literal(kind).label('type'), model.id.label('id'), searched.label('text'), rank.label('rank'))
+        .where(vector.op('@@')(query))
+    )
+
+
+def sqlite_hits(kind, terms):
+    """`postgres_hits` on the FTS5 table of `kind`"""
+    model, field = SEARCHABLE[kind]
+    fts = table(f'{model.__tablename__}_search', column('rowid'), column(field))
+    # bm25() is lower for better matches
+    rank = -func.bm25(literal_column(fts.name))
+    return (
+        select(literal(kind).label('type'), fts.c.rowid.label('id'), fts.c[field].label('text'), rank.label('rank'))
+        .where(literal_column(fts.name).op('MATCH')(' '.join(f'"{t}"*' for t in terms)))
+    )
+
+
+HITS = {'postgresql': postgres_hits, 'sqlite': sqlite_hits}
+
+
+def encode_cursor(hit):
+    return urlsafe_b64encode(json.dumps([hit.rank, hit.type, hit.id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """(rank, type, id) of a cursor, raises ValueError if it's not one"""
+    rank, kind, pk = json.loads(urlsafe_b64decode(cursor.encode()))
+    return float(rank), str(kind), int(pk)
+
+
+def search_page(terms, kinds, after=None, limit=50):
+    """A page of the rows of `kinds` matching all of `terms`, the best matches first,
+    continuing after the cursor `after`. Ties are broken by type and id.
+    Returns the hits and the cursor of the next page (None if it's the last one)
+    """
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        # starting parallel workers takes longer than a selective search does
+        db.session.execute(text('SET LOCAL max_parallel_workers_per_gather = 0'))
+    hits = HITS[dialect]
+    hits = union_all(*(hits(kind, terms) for kind in kinds)).subquery()
+    query = select(hits)
+    if after is not None:
+        rank, kind, pk = after
+        query = query.where(or_(
+            hits.c.rank < rank,
+            and_(hits.c.rank == rank, tuple_(hits.c.type, hits.c.id) > tuple_(kind, pk)),
+        ))
+    # fetch one extra row to know if there is a next page
+    query = query.order_by(hits.c.rank.desc(), hits.c.type, hits.c.id).limit(limit + 1)
+    rows = db.session.execute(query).all()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return [
+        {'type': row.type, 'id': row.id, SEARCHABLE[row.type][1]: row.text, 'rank': row.rank}
+        for row in rows[:limit]
+    ], next_cursor
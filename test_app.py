@@ -1,13 +1,45 @@
+import asyncio
+import gzip
 import json
+import os
+import runpy
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import date
+from pathlib import Path
+from unittest import mock
+
+import brotli
+import rsa
 
 from flask import Flask
 from flask.testing import FlaskClient
 from flask_sqlalchemy import SQLAlchemy
-
+from jose.utils import long_to_base64
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.exceptions import NotFound, TooManyRequests
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+import src
+from src import encoding
 from src.app import create_app
+from src.asgi import AsyncApp
+from src.auth import AuthError, TokenCache
+from src.cache import LRUCache, setup_cache, resource_cache
+from src.compression import compressed_cache, compress_body
+from src.groupcommit import group_committer, setup_group_commit
+from src.jwks import KeyStore
+from src.metrics import Histogram, Registry, current_timer, setup_metrics, span
+from src.queries import record_queries, setup_query_recorder
+from src.ratelimit import MemoryStore, RateLimiter, parse_budget, parse_budgets, setup_rate_limit
 from src.models import setup_db, db, Actor, Movie
+from src.routing import recent_writers
+from src.search import search_page
 
 
 class MyTestCase(unittest.TestCase):
@@ -72,11 +104,45 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 403)
         self.assertEqual(data['success'], False)
 
-    def get(self, *args, **kwargs):
+    def get(self, *args, headers=None, **kwargs):
         return self.client.get(*args, **kwargs, headers={
             'Authorization': f'Bearer {self.jwt}',
+            **(headers or {}),
         })
 
+    def separate_app(self):
+        """Another app on the test database, for tests adding hooks to it"""
+        app = create_app()
+        setup_db(app, self.database_path)
+        db.app = self.app
+        return app
+
+    def asgi_get(self, path, query_string=b'', headers=None):
+        """GET through the ASGI app, returns status, headers and body of the response"""
+        async def call():
+            app = AsyncApp(self.app)
+            messages = []
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            async def send(message):
+                messages.append(message)
+            await app({
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'scheme': 'http',
+                'method': 'GET', 'path': path, 'raw_path': path.encode(), 'root_path': '',
+                'query_string': query_string, 'server': ('localhost', 80), 'client': ('127.0.0.1', 1),
+                'headers': [
+                    (b'host', b'localhost'),
+                    (b'authorization', f'Bearer {self.jwt}'.encode()),
+                    *((k.lower().encode(), v.encode()) for k, v in (headers or {}).items()),
+                ],
+            }, receive, send)
+            for engine in app.engines:
+                await engine.dispose()
+            return messages
+        messages = asyncio.run(call())
+        headers = {k.decode(): v.decode() for k, v in messages[0]['headers']}
+        return messages[0]['status'], headers, b''.join(m.get('body', b'') for m in messages[1:])
+
     def post(self, *args, **kwargs):
         return self.client.post(*args, **kwargs, headers={
             'Authorization': f'Bearer {self.jwt}',
@@ -87,6 +153,11 @@ class MyTestCase(unittest.TestCase):
             'Authorization': f'Bearer {self.jwt}',
         })
 
+    def put(self, *args, **kwargs):
+        return self.client.put(*args, **kwargs, headers={
+            'Authorization': f'Bearer {self.jwt}',
+        })
+
     def delete(self, *args, **kwargs):
         return self.client.delete(*args, **kwargs, headers={
             'Authorization': f'Bearer {self.jwt}',
@@ -110,6 +181,158 @@ class CastingAssistantTest(MyTestCase):
         self.assertEqual(res.status_code, 200)
         self.assertIsInstance(data['movies'], list)
 
+    def test_get_movies_query_count(self):
+        with record_queries() as queries:
+            self.get('/movies')
+        self.assertLessEqual(queries.count, 2)
+
+    def test_get_movie_query_count(self):
+        pk = Movie(**self.sample_movie).insert().id
+        with record_queries() as queries:
+            self.get(f'/movies/{pk}')
+        self.assertEqual(queries.count, 1)
+
+    def test_query_count_warning(self):
+        app = self.separate_app()
+        setup_query_recorder(app, threshold=1)
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            app.test_client().get('/actors', headers={'Authorization': f'Bearer {self.jwt}', 'If-None-Match': '"x"'})
+        self.assertIn('GET /actors issued 2 queries', logs.output[0])
+
+    def test_cache_stats(self):
+        self.assertEqual(self.client.get('/internal/cache').status_code, 404)
+        self.app.config['EXPOSE_INTERNALS'] = True
+        try:
+            res = self.client.get('/internal/cache')
+        finally:
+            self.app.config['EXPOSE_INTERNALS'] = False
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('hits', json.loads(res.data)['tokens'])
+
+    def test_pool_stats(self):
+        self.assertEqual(self.client.get('/internal/pool').status_code, 404)
+        self.app.config['EXPOSE_INTERNALS'] = True
+        try:
+            res = self.client.get('/internal/pool')
+        finally:
+            self.app.config['EXPOSE_INTERNALS'] = False
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['pool']['class'], 'TimedQueuePool')
+        self.assertGreater(data['pool']['wait_seconds']['count'], 0)
+
+    def test_get_actors_paginated(self):
+        ids = [Actor(**self.sample_actor).insert().id for _ in range(3)]
+        res = self.get(f'/actors?after={ids[0] - 1}&limit=2')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a['id'] for a in data['actors']], ids[:2])
+        self.assertEqual(data['next'], ids[1])
+        res = self.get(f'/actors?after={data["next"]}&limit=2')
+        data = json.loads(res.data)
+        self.assertEqual(data['actors'][0]['id'], ids[2])
+
+    def test_get_actors_bad_limit(self):
+        res = self.get('/actors?limit=0')
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_actors_filtered(self):
+        for age in (30, 35, 40, 45):
+            Actor(name=self.id(), age=age, gender=1).insert()
+        res = self.get(f'/actors?name_prefix={self.id()}&age_min=35&age_max=40&gender=1&sort=-age')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a['age'] for a in data['actors']], [40, 35])
+
+    def test_get_actors_sorted_pages(self):
+        for age in (3, 1, 2):
+            Actor(name=self.id(), age=age, gender=0).insert()
+        ages = []
+        url = f'/actors?name_prefix={self.id()}&sort=age&limit=1'
+        data = json.loads(self.get(url).data)
+        while True:
+            ages += [a['age'] for a in data['actors']]
+            if data['next'] is None:
+                break
+            data = json.loads(self.get(f'{url}&after={data["next"]}').data)
+        self.assertEqual(ages, [1, 2, 3])
+
+    def test_asgi_get_actors(self):
+        for age in (3, 1, 2):
+            Actor(name=self.id(), age=age, gender=0).insert()
+        query = f'name_prefix={self.id()}&sort=age&limit=2'
+        status, headers, body = self.asgi_get('/actors', query.encode())
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), json.loads(self.get(f'/actors?{query}').data))
+        status, _, _ = self.asgi_get('/actors', query.encode(), headers={'If-None-Match': headers['etag']})
+        self.assertEqual(status, 304)
+
+    def test_asgi_get_actor(self):
+        pk = Actor(**self.sample_actor).insert().id
+        status, headers, body = self.asgi_get(f'/actors/{pk}')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['actor']['name'], self.sample_actor['name'])
+        self.assertEqual(headers['etag'], self.get(f'/actors/{pk}').headers['ETag'])
+        status, _, body = self.asgi_get('/actors/0')
+        self.assertEqual(status, 404)
+        self.assertEqual(json.loads(body)['error'], 404)
+
+    def test_asgi_falls_back_to_flask(self):
+        status, headers, _ = self.asgi_get('/actors/export')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['content-type'], 'application/x-ndjson')
+
+    def test_metrics(self):
+        app = self.separate_app()
+        setup_metrics(app)
+        res = app.test_client().get('/actors', headers={'Authorization': f'Bearer {self.jwt}'})
+        self.assertEqual(res.status_code, 200)
+        phases = [metric.split(';')[0] for metric in res.headers['Server-Timing'].split(', ')]
+        self.assertEqual(set(phases), {'auth', 'query', 'format', 'encode', 'total'})
+        self.assertEqual(app.test_client().get('/metrics').status_code, 404)
+        app.config['EXPOSE_INTERNALS'] = True
+        text = app.test_client().get('/metrics').get_data(as_text=True)
+        self.assertIn('http_request_duration_seconds_count{method="GET",route="/actors",status="200"}', text)
+        self.assertIn('phase="query"', text)
+
+    def test_get_movies_filtered(self):
+        Movie(title='Filtered movie', release_date=date(1999, 5, 1)).insert()
+        res = self.get('/movies?release_from=1999-01-01&release_to=1999-12-31')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('Filtered movie', [m['title'] for m in data['movies']])
+        self.assertTrue(all(m['release_date'].startswith('1999') for m in data['movies']))
+
+    def test_get_actors_bad_sort(self):
+        res = self.get('/actors?sort=gender')
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_actors_fields(self):
+        Actor(**self.sample_actor).insert()
+        res = self.get('/actors?fields=id,name')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['actors'][0]), {'id', 'name'})
+
+    def test_get_movie_fields(self):
+        mid = Movie(**self.sample_movie).insert().id
+        res = self.get(f'/movies/{mid}?fields=release_date')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie'], {'release_date': self.sample_movie['release_date']})
+
+    def test_get_actors_bad_fields(self):
+        res = self.get('/actors?fields=id,password')
+        self.assertEqual(res.status_code, 400)
+
+    def test_export_actors(self):
+        aid = Actor(**self.sample_actor).insert().id
+        res = self.get('/actors/export')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in res.data.splitlines()]
+        self.assertIn(aid, [a['id'] for a in lines])
+
     def test_get_an_actor(self):
         a = Actor(**self.sample_actor).insert()
         aid = a.id
@@ -119,6 +342,20 @@ class CastingAssistantTest(MyTestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['actor']['name'], a.name)
 
+    def test_get_actor_not_modified(self):
+        aid = Actor(**self.sample_actor).insert().id
+        res = self.get(f'/actors/{aid}')
+        etag = res.headers['ETag']
+        self.assertIsNotNone(res.headers.get('Last-Modified'))
+        res = self.get(f'/actors/{aid}', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_get_movies_not_modified(self):
+        res = self.get('/movies')
+        res = self.get('/movies', headers={'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
     def test_get_actor_404(self):
         aid = 999
         res = self.get(f'/actors/{aid}')
@@ -152,12 +389,171 @@ class CastingAssistantTest(MyTestCase):
     def test_post_movie(self):
         self.error_forbidden('post', '/movies', self.sample_movie)
 
+    def test_post_actors_bulk(self):
+        self.error_forbidden('post', '/actors/bulk', [self.sample_actor])
+
+    def test_patch_actors_bulk(self):
+        self.error_forbidden('patch', '/actors/bulk', {'ids': [1], 'patch': {}})
+
+    def test_delete_actors_bulk(self):
+        self.error_forbidden('delete', '/actors/bulk', {'ids': [1]})
+
     def test_patch_actor(self):
         self.error_forbidden('patch', '/actors/1', {})
 
     def test_patch_movie(self):
         self.error_forbidden('patch', '/movies/1', {})
 
+    def test_set_movie_actors(self):
+        self.error_forbidden('put', '/movies/1/actors', {'ids': []})
+
+    def test_get_movie_actors_404(self):
+        res = self.get('/movies/999/actors')
+        self.assertEqual(res.status_code, 404)
+
+    def test_get_movies_bad_include(self):
+        res = self.get('/movies?include=directors')
+        self.assertEqual(res.status_code, 400)
+
+    def test_gzip(self):
+        for i in range(30):
+            Actor(name=f'Compressed {i}', age=30, gender=0).insert()
+        plain = self.get('/actors?name_prefix=Compressed')
+        res = self.get('/actors?name_prefix=Compressed', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertLess(len(res.data), len(plain.data))
+        self.assertEqual(json.loads(gzip.decompress(res.data)), json.loads(plain.data))
+        # compressed responses have a weak ETag, which still matches
+        self.assertEqual(res.headers['ETag'], f"W/{plain.headers['ETag']}")
+        res = self.get('/actors?name_prefix=Compressed', headers={'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+    def test_brotli_is_preferred(self):
+        for i in range(30):
+            Actor(name=f'Compressed {i}', age=30, gender=0).insert()
+        res = self.get('/actors?name_prefix=Compressed', headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(res.headers['Content-Encoding'], 'br')
+        self.assertTrue(json.loads(brotli.decompress(res.data))['success'])
+
+    def test_small_body_uncompressed(self):
+        res = self.get('/movies/499', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(json.loads(res.data)['movie']['id'], 499)
+
+    def test_compressed_cache(self):
+        for i in range(30):
+            Actor(name=f'Compressed {i}', age=30, gender=0).insert()
+        hits = compressed_cache.hits
+        first = self.get('/actors?name_prefix=Compressed&limit=20', headers={'Accept-Encoding': 'gzip'})
+        second = self.get('/actors?name_prefix=Compressed&limit=20', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(compressed_cache.hits, hits + 1)
+        self.assertEqual(first.data, second.data)
+
+    def test_export_gzip(self):
+        res = self.get('/movies/export', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        lines = gzip.decompress(res.data).splitlines()
+        self.assertIn(499, [json.loads(line)['id'] for line in lines])
+
+    def test_asgi_gzip(self):
+        for i in range(30):
+            Actor(name=f'Compressed {i}', age=30, gender=0).insert()
+        status, headers, body = self.asgi_get('/actors', b'name_prefix=Compressed', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        self.assertTrue(headers['etag'].startswith('W/'))
+        self.assertTrue(json.loads(gzip.decompress(body))['success'])
+
+    def test_rate_limit(self):
+        app = self.separate_app()
+        setup_rate_limit(app, default='2/60', budgets='get_actors=1/60')
+        try:
+            client = app.test_client()
+            headers = {'Authorization': f'Bearer {self.jwt}'}
+            self.assertEqual(client.get('/actors', headers=headers).status_code, 200)
+            res = client.get('/actors', headers=headers)
+            self.assertEqual(res.status_code, 429)
+            self.assertEqual(res.headers['Retry-After'], '60')
+            self.assertEqual(json.loads(res.data)['error'], 429)
+            # the other routes share the default budget
+            self.assertEqual(client.get('/movies', headers=headers).status_code, 200)
+            self.assertEqual(client.get('/movies/499', headers=headers).status_code, 200)
+            self.assertEqual(client.get('/movies', headers=headers).status_code, 429)
+            # public routes are limited on the client address
+            self.assertEqual([client.get('/').status_code for _ in range(3)], [200, 200, 429])
+        finally:
+            setup_rate_limit(app, default='', budgets='')
+
+    def test_rate_limit_bad_tokens(self):
+        app = self.separate_app()
+        setup_rate_limit(app, budgets='verify_token=2/60')
+        try:
+            client = app.test_client()
+            headers = {'Authorization': 'Bearer junk'}
+            with mock.patch('src.auth.verify_decode_jwt', side_effect=AuthError({}, 401)) as verify:
+                self.assertEqual([client.get('/actors', headers=headers).status_code for _ in range(3)], [401, 401, 429])
+            # the signature of the last one wasn't checked
+            self.assertEqual(verify.call_count, 2)
+        finally:
+            setup_rate_limit(app, default='', budgets='')
+
+    def test_asgi_rate_limit(self):
+        setup_rate_limit(self.separate_app(), budgets='get_movie=1/60')
+        try:
+            self.assertEqual(self.asgi_get('/movies/499')[0], 200)
+            status, headers, body = self.asgi_get('/movies/499')
+            self.assertEqual(status, 429)
+            self.assertEqual(headers['retry-after'], '60')
+            self.assertEqual(json.loads(body)['error'], 429)
+        finally:
+            setup_rate_limit(self.separate_app(), default='', budgets='')
+
+    def test_actor_stats(self):
+        Actor(name='Stats', age=1047, gender=1).insert()
+        res = self.get('/stats/actors')
+        data = json.loads(res.data)['actors']
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total'], sum(g['count'] for g in data['by_gender']))
+        self.assertIn({'age_from': 1040, 'age_to': 1049, 'count': 1}, data['by_age'])
+        self.assertIn({'gender': 1, 'age_from': 1040, 'count': 1}, data['by_gender_and_age'])
+
+    def test_movie_stats(self):
+        Movie(title='Stats', release_date=date(1895, 12, 28)).insert()
+        res = self.get('/stats/movies')
+        data = json.loads(res.data)['movies']
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total'], sum(y['count'] for y in data['by_year']))
+        self.assertIn({'year': 1895, 'count': 1}, data['by_year'])
+
+    def test_search(self):
+        hanks, jones = (Actor(name=n, age=40, gender=0).insert().id for n in ('Zorba Hanks', 'Zorbas Jones'))
+        mid = Movie(title='Zorba the Greek', release_date=date(1964, 12, 17)).insert().id
+        res = self.get('/search?q=zorba')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            {(r['type'], r['id']) for r in data['results']},
+            {('actor', hanks), ('actor', jones), ('movie', mid)},
+        )
+        # whole words rank first
+        self.assertEqual(data['results'][-1]['name'], 'Zorbas Jones')
+        data = json.loads(self.get('/search?q=ZORB han&type=actor').data)
+        self.assertEqual([r['name'] for r in data['results']], ['Zorba Hanks'])
+
+    def test_search_pages(self):
+        ids = {Actor(name=f'Quokka {i}', age=40, gender=0).insert().id for i in range(3)}
+        data = json.loads(self.get('/search?q=quokka&limit=2').data)
+        self.assertEqual(len(data['results']), 2)
+        rest = json.loads(self.get(f'/search?q=quokka&limit=2&after={data["next"]}').data)
+        self.assertIsNone(rest['next'])
+        self.assertEqual({r['id'] for r in data['results'] + rest['results']}, ids)
+
+    def test_search_400(self):
+        for query in ('', 'q=', 'q=%21%3F', 'q=tom&type=director', 'q=tom&limit=0', 'q=tom&after=nope'):
+            with self.subTest(query):
+                self.assertEqual(self.get(f'/search?{query}').status_code, 400)
+
 
 class CastingDirectorTest(MyTestCase):
     def __init__(self, *args, **kwargs):
@@ -170,9 +566,45 @@ class CastingDirectorTest(MyTestCase):
     def test_get_movies(self):
         CastingAssistantTest.test_get_movies(self)  # noqa
 
+    def test_get_actors_paginated(self):
+        CastingAssistantTest.test_get_actors_paginated(self)  # noqa
+
+    def test_get_actors_bad_limit(self):
+        CastingAssistantTest.test_get_actors_bad_limit(self)  # noqa
+
+    def test_get_actors_filtered(self):
+        CastingAssistantTest.test_get_actors_filtered(self)  # noqa
+
+    def test_get_actors_sorted_pages(self):
+        CastingAssistantTest.test_get_actors_sorted_pages(self)  # noqa
+
+    def test_get_movies_filtered(self):
+        CastingAssistantTest.test_get_movies_filtered(self)  # noqa
+
+    def test_get_actors_bad_sort(self):
+        CastingAssistantTest.test_get_actors_bad_sort(self)  # noqa
+
+    def test_get_actors_fields(self):
+        CastingAssistantTest.test_get_actors_fields(self)  # noqa
+
+    def test_get_movie_fields(self):
+        CastingAssistantTest.test_get_movie_fields(self)  # noqa
+
+    def test_get_actors_bad_fields(self):
+        CastingAssistantTest.test_get_actors_bad_fields(self)  # noqa
+
+    def test_export_actors(self):
+        CastingAssistantTest.test_export_actors(self)  # noqa
+
     def test_get_an_actor(self):
         CastingAssistantTest.test_get_an_actor(self)  # noqa
 
+    def test_get_actor_not_modified(self):
+        CastingAssistantTest.test_get_actor_not_modified(self)  # noqa
+
+    def test_get_movies_not_modified(self):
+        CastingAssistantTest.test_get_movies_not_modified(self)  # noqa
+
     def test_get_actor_404(self):
         CastingAssistantTest.test_get_actor_404(self)  # noqa
 
@@ -215,6 +647,66 @@ class CastingDirectorTest(MyTestCase):
     def test_post_movie(self):
         CastingAssistantTest.test_post_movie(self)  # noqa
 
+    def test_post_actors_bulk(self):
+        res = self.post('/actors/bulk', json=[self.sample_actor, self.bad_actor, self.sample_actor])
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([r['success'] for r in data['results']], [True, False, True])
+        self.assertEqual(len(data['ids']), 2)
+        self.assertEqual(Actor.query.get(data['ids'][1]).name, self.sample_actor['name'])
+
+    def test_post_actors_bulk_400(self):
+        res = self.post('/actors/bulk', json=self.sample_actor)
+        self.assertEqual(res.status_code, 400)
+
+    def test_post_actors_bulk_wrong_types(self):
+        res = self.post('/actors/bulk', json=[
+            {'name': 5, 'age': 'abc'},
+            dict(self.sample_actor, age=True),
+            dict(self.sample_actor, gender=2),
+            self.sample_actor,
+        ])
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([r['success'] for r in json.loads(res.data)['results']], [False, False, False, True])
+
+    def test_patch_actors_bulk(self):
+        ids = [Actor(**self.sample_actor).insert().id for _ in range(2)]
+        res = self.patch('/actors/bulk', json={'ids': ids + [999], 'patch': {'age': 77}})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], ids)
+        self.assertEqual(data['missing'], [999])
+        self.assertEqual([Actor.query.get(pk).age for pk in ids], [77, 77])
+
+    def test_patch_actors_bulk_wrong_types(self):
+        ids = [Actor(**self.sample_actor).insert().id for _ in range(2)]
+        for body in (
+            {'ids': ids, 'patch': {'age': 'abc'}},
+            {'ids': ids, 'patch': {'name': None}},
+            {'patches': {str(ids[0]): {'name': 'First'}, str(ids[1]): {'gender': 5}}},
+        ):
+            with self.subTest(body):
+                self.assertEqual(self.patch('/actors/bulk', json=body).status_code, 400)
+        self.assertEqual([Actor.query.get(pk).name for pk in ids], [self.sample_actor['name']] * 2)
+
+    def test_patch_actors_bulk_mapping(self):
+        ids = [Actor(**self.sample_actor).insert().id for _ in range(2)]
+        res = self.patch('/actors/bulk', json={'patches': {
+            str(ids[0]): {'name': 'First'},
+            str(ids[1]): {'name': 'Second'},
+        }})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([Actor.query.get(pk).name for pk in ids], ['First', 'Second'])
+
+    def test_delete_actors_bulk(self):
+        ids = [Actor(**self.sample_actor).insert().id for _ in range(2)]
+        res = self.delete('/actors/bulk', json={'ids': ids + [999]})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], ids)
+        self.assertEqual(data['missing'], [999])
+        self.assertEqual(Actor.query.filter(Actor.id.in_(ids)).count(), 0)
+
     def test_patch_actor(self):
         a = Actor(**self.sample_actor).insert()
         res = self.patch(f'/actors/{a.id}', json=dict(
@@ -234,6 +726,67 @@ class CastingDirectorTest(MyTestCase):
 
         self.assertEqual(res.status_code, 404)
 
+    def test_patch_actor_changes_etag(self):
+        a = Actor(**self.sample_actor).insert()
+        etag = self.get(f'/actors/{a.id}').headers['ETag']
+        self.patch(f'/actors/{a.id}', json=dict(name='My new name'))
+        res = self.get(f'/actors/{a.id}', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_insert_past_page_changes_etag(self):
+        a = Actor(**self.sample_actor).insert()
+        page = f'/actors?after={a.id - 1}&limit=1'
+        res = self.get(page)
+        self.assertIsNone(json.loads(res.data)['next'])
+        etag = res.headers['ETag']
+        Actor(**self.sample_actor).insert()
+        res = self.get(page, headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['next'], a.id)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        status, _, body = self.asgi_get('/actors', f'after={a.id - 1}&limit=1'.encode(), {'If-None-Match': etag})
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['next'], a.id)
+
+    def test_write_of_stale_row(self):
+        a = Actor(**self.sample_actor).insert()
+        stale = Actor.query.get(a.id)
+        self.assertEqual(stale.version, 1)
+        # another request writes the row in between
+        db.engine.execute(Actor.__table__.update().where(Actor.id == a.id).values(**Actor.version_bump()))
+        stale.name = 'Last write'
+        stale.update()
+        self.assertEqual((stale.name, stale.version), ('Last write', 3))
+
+    def test_patch_actor_invalidates_cache(self):
+        setup_cache(size=10)
+        try:
+            a = Actor(**self.sample_actor).insert()
+            self.get(f'/actors/{a.id}')
+            self.get(f'/actors/{a.id}')
+            self.assertEqual(resource_cache.hits, 1)
+            self.patch(f'/actors/{a.id}', json=dict(name='Cached name'))
+            res = self.get(f'/actors/{a.id}')
+            data = json.loads(res.data)
+            self.assertEqual(data['actor']['name'], 'Cached name')
+        finally:
+            setup_cache(size=0)
+
+    def test_actor_stats_invalidated_by_writes(self):
+        setup_cache(size=10)
+        try:
+            total = json.loads(self.get('/stats/actors').data)['actors']['total']
+            with record_queries() as cached:
+                self.get('/stats/actors')
+            self.assertEqual(cached.count, 0)
+            aid = json.loads(self.post('/actors', json=self.sample_actor).data)['actor']['id']
+            self.assertEqual(json.loads(self.get('/stats/actors').data)['actors']['total'], total + 1)
+            self.delete('/actors/bulk', json={'ids': [aid]})
+            self.assertEqual(json.loads(self.get('/stats/actors').data)['actors']['total'], total)
+        finally:
+            setup_cache(size=0)
+
     def test_patch_movie(self):
         m = Movie(**self.sample_movie).insert()
         res = self.patch(f'/movies/{m.id}', json=dict(
@@ -253,6 +806,52 @@ class CastingDirectorTest(MyTestCase):
 
         self.assertEqual(res.status_code, 404)
 
+    def test_set_movie_actors(self):
+        mid = Movie(**self.sample_movie).insert().id
+        ids = [Actor(**self.sample_actor).insert().id for _ in range(2)]
+        res = self.put(f'/movies/{mid}/actors', json={'ids': ids})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a['id'] for a in data['actors']], ids)
+        data = json.loads(self.get(f'/movies/{mid}/actors').data)
+        self.assertEqual([a['id'] for a in data['actors']], ids)
+        data = json.loads(self.get(f'/actors/{ids[0]}/movies').data)
+        self.assertEqual([m['id'] for m in data['movies']], [mid])
+
+    def test_set_movie_actors_422(self):
+        mid = Movie(**self.sample_movie).insert().id
+        res = self.put(f'/movies/{mid}/actors', json={'ids': [0]})
+        self.assertEqual(res.status_code, 422)
+
+    def test_get_movies_include_actors(self):
+        mids = [Movie(title=self.id(), release_date=self.sample_movie['release_date']).insert().id for _ in range(3)]
+        aid = Actor(**self.sample_actor).insert().id
+        for mid in mids:
+            self.put(f'/movies/{mid}/actors', json={'ids': [aid]})
+        url = f'/movies?title_prefix={self.id()}&include=actors'
+        with record_queries() as one:
+            self.get(f'{url}&limit=1')
+        with record_queries() as three:
+            res = self.get(f'{url}&limit=3')
+        data = json.loads(res.data)
+        self.assertEqual([m['actors'][0]['id'] for m in data['movies']], [aid] * 3)
+        self.assertEqual(one.count, three.count)
+
+
+    def test_conditional_cast_and_include(self):
+        mid = Movie(**self.sample_movie).insert().id
+        aid = Actor(**self.sample_actor).insert().id
+        self.put(f'/movies/{mid}/actors', json={'ids': [aid]})
+        for url in (f'/movies/{mid}/actors', f'/actors/{aid}/movies', f'/movies?after={mid - 1}&limit=1&include=actors'):
+            with self.subTest(url):
+                etag = self.get(url).headers['ETag']
+                self.assertEqual(self.get(url, headers={'If-None-Match': etag}).status_code, 304)
+        url = f'/actors?after={aid - 1}&limit=1&include=movies'
+        etag = self.get(url).headers['ETag']
+        self.put(f'/movies/{mid}/actors', json={'ids': []})
+        res = self.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['actors'][0]['movies'], [])
 
 class ExecutiveProducerTest(MyTestCase):
     def __init__(self, *args, **kwargs):
@@ -265,9 +864,45 @@ class ExecutiveProducerTest(MyTestCase):
     def test_get_movies(self):
         CastingDirectorTest.test_get_movies(self)  # noqa
 
+    def test_get_actors_paginated(self):
+        CastingDirectorTest.test_get_actors_paginated(self)  # noqa
+
+    def test_get_actors_bad_limit(self):
+        CastingDirectorTest.test_get_actors_bad_limit(self)  # noqa
+
+    def test_get_actors_filtered(self):
+        CastingDirectorTest.test_get_actors_filtered(self)  # noqa
+
+    def test_get_actors_sorted_pages(self):
+        CastingDirectorTest.test_get_actors_sorted_pages(self)  # noqa
+
+    def test_get_movies_filtered(self):
+        CastingDirectorTest.test_get_movies_filtered(self)  # noqa
+
+    def test_get_actors_bad_sort(self):
+        CastingDirectorTest.test_get_actors_bad_sort(self)  # noqa
+
+    def test_get_actors_fields(self):
+        CastingDirectorTest.test_get_actors_fields(self)  # noqa
+
+    def test_get_movie_fields(self):
+        CastingDirectorTest.test_get_movie_fields(self)  # noqa
+
+    def test_get_actors_bad_fields(self):
+        CastingDirectorTest.test_get_actors_bad_fields(self)  # noqa
+
+    def test_export_actors(self):
+        CastingDirectorTest.test_export_actors(self)  # noqa
+
     def test_get_an_actor(self):
         CastingDirectorTest.test_get_an_actor(self)  # noqa
 
+    def test_get_actor_not_modified(self):
+        CastingDirectorTest.test_get_actor_not_modified(self)  # noqa
+
+    def test_get_movies_not_modified(self):
+        CastingDirectorTest.test_get_movies_not_modified(self)  # noqa
+
     def test_get_actor_404(self):
         CastingDirectorTest.test_get_actor_404(self)  # noqa
 
@@ -316,18 +951,541 @@ class ExecutiveProducerTest(MyTestCase):
         _data = json.loads(res.data)
         self.assertEqual(res.status_code, 400)
 
+    def test_post_actors_bulk(self):
+        CastingDirectorTest.test_post_actors_bulk(self)  # noqa
+
+    def test_post_actors_bulk_400(self):
+        CastingDirectorTest.test_post_actors_bulk_400(self)  # noqa
+
+    def test_post_actors_bulk_wrong_types(self):
+        CastingDirectorTest.test_post_actors_bulk_wrong_types(self)  # noqa
+
+    def test_patch_actors_bulk(self):
+        CastingDirectorTest.test_patch_actors_bulk(self)  # noqa
+
+    def test_patch_actors_bulk_wrong_types(self):
+        CastingDirectorTest.test_patch_actors_bulk_wrong_types(self)  # noqa
+
+    def test_patch_actors_bulk_mapping(self):
+        CastingDirectorTest.test_patch_actors_bulk_mapping(self)  # noqa
+
+    def test_delete_actors_bulk(self):
+        CastingDirectorTest.test_delete_actors_bulk(self)  # noqa
+
+    def test_delete_movies_bulk(self):
+        mid = Movie(**self.sample_movie).insert().id
+        res = self.delete('/movies/bulk', json={'ids': [mid]})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], [mid])
+        self.assertIsNone(Movie.query.get(mid))
+
+    def test_post_movies_bulk_ndjson(self):
+        body = '\n'.join(json.dumps(m) for m in (self.sample_movie, self.bad_movie))
+        res = self.post('/movies/bulk', data=body, content_type='application/x-ndjson')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([r['success'] for r in data['results']], [True, False])
+        self.assertEqual(Movie.query.get(data['ids'][0]).title, self.sample_movie['title'])
+
+    def test_post_movies_bulk_wrong_types(self):
+        res = self.post('/movies/bulk', json=[
+            dict(self.sample_movie, title=5),
+            dict(self.sample_movie, title='x' * 81),
+            dict(self.sample_movie, release_date=20220501),
+            self.sample_movie,
+        ])
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([r['success'] for r in json.loads(res.data)['results']], [False, False, False, True])
+
     def test_patch_actor(self):
         CastingDirectorTest.test_patch_actor(self)  # noqa
 
     def test_patch_actor_404(self):
         CastingDirectorTest.test_patch_actor_404(self)  # noqa
 
+    def test_patch_actor_changes_etag(self):
+        CastingDirectorTest.test_patch_actor_changes_etag(self)  # noqa
+
+    def test_insert_past_page_changes_etag(self):
+        CastingDirectorTest.test_insert_past_page_changes_etag(self)  # noqa
+
+    def test_write_of_stale_row(self):
+        CastingDirectorTest.test_write_of_stale_row(self)  # noqa
+
+    def test_patch_actor_invalidates_cache(self):
+        CastingDirectorTest.test_patch_actor_invalidates_cache(self)  # noqa
+
+    def test_actor_stats_invalidated_by_writes(self):
+        CastingDirectorTest.test_actor_stats_invalidated_by_writes(self)  # noqa
+
     def test_patch_movie(self):
         CastingDirectorTest.test_patch_movie(self)  # noqa
 
     def test_patch_movie_404(self):
         CastingDirectorTest.test_patch_movie_404(self)  # noqa
 
+    def test_set_movie_actors(self):
+        CastingDirectorTest.test_set_movie_actors(self)  # noqa
+
+    def test_set_movie_actors_422(self):
+        CastingDirectorTest.test_set_movie_actors_422(self)  # noqa
+
+    def test_get_movies_include_actors(self):
+        CastingDirectorTest.test_get_movies_include_actors(self)  # noqa
+
+    def test_conditional_cast_and_include(self):
+        CastingDirectorTest.test_conditional_cast_and_include(self)  # noqa
+
+
+class TokenCacheTest(unittest.TestCase):
+    def test_hit_and_miss(self):
+        cache = TokenCache(maxsize=2)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', {'exp': time.time() + 60, 'sub': 'a'})
+        self.assertEqual(cache.get('a')['sub'], 'a')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_expired_token_is_evicted(self):
+        cache = TokenCache()
+        cache.set('a', {'exp': time.time() - 1})
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_lru_eviction(self):
+        cache = TokenCache(maxsize=2)
+        for token in 'abc':
+            cache.set(token, {'exp': time.time() + 60})
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_ttl(self):
+        cache = LRUCache(ttl=-1)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_lru_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+
+
+class KeyStoreTest(unittest.TestCase):
+    def setUp(self):
+        public_key, _ = rsa.newkeys(512)
+        self.file = tempfile.NamedTemporaryFile('w', suffix='.json')
+        json.dump({'keys': [{
+            'kty': 'RSA', 'kid': 'key1', 'use': 'sig',
+            'n': long_to_base64(public_key.n).decode(),
+            'e': long_to_base64(public_key.e).decode(),
+        }]}, self.file)
+        self.file.flush()
+
+    def tearDown(self):
+        self.file.close()
+
+    def test_load_from_file(self):
+        store = KeyStore(file=self.file.name)
+        self.assertIsNotNone(store.get('key1'))
+        self.assertEqual(store.fetches, 0)
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        store = KeyStore(url='http://localhost:9/jwks.json', file=self.file.name)
+        self.assertIsNone(store.get('key2'))
+        self.assertIsNone(store.get('key2'))
+        self.assertEqual(store.fetches, 1)
+
+    def test_url_resolved_on_first_use(self):
+        calls = []
+        store = KeyStore(url=lambda: calls.append(1) or 'http://localhost:9/jwks.json', file=self.file.name)
+        self.assertEqual(calls, [])
+        self.assertEqual(store.url, 'http://localhost:9/jwks.json')
+        self.assertEqual(store.url, 'http://localhost:9/jwks.json')
+        self.assertEqual(calls, [1])
+
+    def test_after_fork_forgets_refresh_thread(self):
+        store = KeyStore(url='http://localhost:9/jwks.json', file=self.file.name)
+        store.start()
+        thread, stop = store._thread, store._stop
+        store.after_fork()
+        self.assertIsNone(store._thread)
+        store.start()
+        self.assertIsNot(store._thread, thread)
+        store.stop()
+        stop.set()
+
+
+class StartupTest(unittest.TestCase):
+    def run_python(self, code):
+        env = {k: v for k, v in os.environ.items() if k not in ('AUTH0_DOMAIN', 'API_AUDIENCE', 'DATABASE')}
+        return subprocess.run(
+            [sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True,
+        ).stdout.split()
+
+    def test_import_has_no_side_effects(self):
+        # no app, no settings required, nothing connecting
+        self.assertEqual(self.run_python(
+            'import src, src.app, src.asgi, src.pool; print(len(src.pool.engines), "APP" in vars(src))'
+        ), ['0', 'False'])
+
+    def test_app_created_on_first_access(self):
+        self.assertEqual(self.run_python('import src; print(type(src.APP).__name__, src.APP is src.APP)'), ['Flask', 'True'])
+
+    def test_cache_settings_read_when_set_up(self):
+        try:
+            with mock.patch.dict(os.environ, CACHE_SIZE='3', CACHE_TTL='5'):
+                setup_cache()
+            self.assertEqual((resource_cache.backend.maxsize, resource_cache.backend.ttl), (3, 5))
+        finally:
+            setup_cache(size=0)
+
+    def gunicorn_settings(self, **env):
+        with mock.patch.dict(os.environ, env):
+            return runpy.run_path(str(Path(src.__file__).parent.parent / 'gunicorn.conf.py'))
+
+    def test_gunicorn_settings(self):
+        settings = self.gunicorn_settings(SERVER_MODE='wsgi', DB_POOL_SIZE='8')
+        self.assertEqual(settings['wsgi_app'], 'src.app:create_app()')
+        self.assertEqual(settings['worker_class'], 'gthread')
+        self.assertEqual(settings['threads'], 8)
+        self.assertTrue(settings['preload_app'])
+        settings = self.gunicorn_settings(SERVER_MODE='asgi', WEB_CONCURRENCY='3')
+        self.assertEqual(settings['wsgi_app'], 'src.asgi:create_asgi_app()')
+        self.assertEqual(settings['worker_class'], 'uvicorn.workers.UvicornWorker')
+        self.assertEqual(settings['workers'], 3)
+        self.assertEqual(settings['threads'], 1)
+        # more than one thread would turn sync workers into gthread ones
+        self.assertEqual(self.gunicorn_settings(SERVER_MODE='wsgi', WORKER_CLASS='sync')['threads'], 1)
+
+
+class HistogramTest(unittest.TestCase):
+    def test_cumulative_buckets(self):
+        histogram = Histogram((1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['buckets'], {'1': 2, '5': 3, '+Inf': 4})
+        self.assertEqual(snapshot['count'], 4)
+        self.assertEqual(snapshot['sum'], 14.5)
+
+
+class RegistryTest(unittest.TestCase):
+    def test_render(self):
+        registry = Registry(bounds=(1,))
+        registry.observe('GET', '/actors', 200, 0.5, {'query': 2})
+        lines = registry.render().splitlines()
+        self.assertIn('http_request_duration_seconds_bucket{method="GET",route="/actors",status="200",le="1"} 1', lines)
+        self.assertIn('http_request_phase_seconds_bucket{method="GET",route="/actors",phase="query",le="1"} 0', lines)
+        self.assertIn('http_request_phase_seconds_count{method="GET",route="/actors",phase="query"} 1', lines)
+
+    def test_span_without_timer(self):
+        self.assertIsNone(current_timer.get())
+        with span('query'):
+            pass
+
+
+class EncodingTest(unittest.TestCase):
+    def test_encoders_agree(self):
+        obj = {'success': True, 'movies': [{'id': 1, 'title': 'Über', 'release_date': date(2020, 1, 2)}]}
+        expected = {'success': True, 'movies': [{'id': 1, 'title': 'Über', 'release_date': '2020-01-02'}]}
+        for name, dumps in encoding.ENCODERS.items():
+            with self.subTest(name):
+                self.assertEqual(json.loads(dumps(obj)), expected)
+
+
+class CompressionTest(unittest.TestCase):
+    def test_cache_keyed_by_body(self):
+        hits = compressed_cache.hits
+        old, new = b'{"next": null}' * 100, b'{"next": 1234}' * 100
+        compress_body(old, 'gzip', cache=True)
+        self.assertEqual(gzip.decompress(compress_body(new, 'gzip', cache=True)), new)
+        self.assertEqual(gzip.decompress(compress_body(old, 'gzip', cache=True)), old)
+        self.assertEqual(compressed_cache.hits, hits + 1)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_burst_then_refill(self):
+        limiter = RateLimiter(default=parse_budget('2/0.05'))
+        limiter.check('get_actors', 'a')
+        limiter.check('get_actors', 'a')
+        with self.assertRaises(TooManyRequests) as e:
+            limiter.check('get_actors', 'a')
+        self.assertEqual(e.exception.retry_after, 1)
+        # other clients have buckets of their own
+        limiter.check('get_actors', 'b')
+        time.sleep(0.03)
+        limiter.check('get_actors', 'a')
+        self.assertEqual(limiter.limited, 1)
+
+    def test_route_budgets(self):
+        limiter = RateLimiter(budgets=parse_budgets('export_actors=1/60, get_actors = 5/1'))
+        self.assertEqual(limiter.budgets['get_actors'], parse_budget('5/1'))
+        limiter.check('export_actors', 'a')
+        self.assertRaises(TooManyRequests, limiter.check, 'export_actors', 'a')
+        # without a default budget the other routes aren't limited
+        for _ in range(10):
+            limiter.check('get_movies', 'a')
+
+    def test_verify_budget(self):
+        limiter = RateLimiter(default=parse_budget('1/60'))
+        limiter.check_verify('1.2.3.4')
+        self.assertRaises(TooManyRequests, limiter.check_verify, '1.2.3.4')
+        # verifications have a bucket apart from the address's requests
+        limiter.check('index', '1.2.3.4')
+
+    def test_bad_budgets(self):
+        for budget in ('10', '0/60', '10/0', 'ten/60'):
+            with self.subTest(budget):
+                self.assertRaises(ValueError, parse_budget, budget)
+
+    def test_store_is_bounded(self):
+        store = MemoryStore(shards=4, maxsize=8)
+        for i in range(100):
+            store.take(i, 1, 1)
+        self.assertLessEqual(len(store), 8)
+
+
+class ReplicaRoutingTest(unittest.TestCase):
+    """Two sqlite files stand in for the primary and its replica"""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.app = create_app()
+        setup_db(self.app, f'sqlite:///{self.dir.name}/primary.db', [f'sqlite:///{self.dir.name}/replica.db'])
+        with self.app.app_context():
+            db.create_all()
+            db.metadata.create_all(db.get_engine(self.app, 'replica0'))
+            db.get_engine(self.app, 'replica0').execute(Actor.__table__.insert(), name='On replica', age=1, gender=0)
+        recent_writers.clear()
+
+    def tearDown(self):
+        recent_writers.clear()
+        if MyTestCase.app is not None:
+            db.app = MyTestCase.app
+        self.dir.cleanup()
+
+    def count(self, method='GET', headers=None):
+        with self.app.test_request_context('/actors', method=method, headers=headers):
+            count = Actor.query.filter_by(name='On replica').count()
+            db.session.remove()
+            return count
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(self.count('GET'), 1)
+
+    def test_writes_go_to_primary(self):
+        self.assertEqual(self.count('POST'), 0)
+
+    def test_read_your_writes(self):
+        with self.app.test_request_context('/actors', method='POST'):
+            Actor(name='On primary', age=2, gender=1).insert()
+            db.session.remove()
+        self.assertEqual(self.count('GET'), 0)
+        recent_writers.clear()
+        self.assertEqual(self.count('GET'), 1)
+
+    def test_write_sets_cookie(self):
+        with self.app.test_request_context('/actors', method='POST'):
+            Actor(name='On primary', age=2, gender=1).insert()
+            db.session.remove()
+            response = self.app.process_response(self.app.make_response(''))
+        self.assertIn('last_write=', response.headers['Set-Cookie'])
+
+    def test_cookie_of_other_worker(self):
+        # a write handled by another worker, which only the cookie tells about
+        self.assertEqual(self.count('GET', {'Cookie': f'last_write={time.time()}'}), 0)
+        self.assertEqual(self.count('GET', {'Cookie': f'last_write={time.time() - 60}'}), 1)
+        self.assertEqual(self.count('GET', {'Cookie': 'last_write=garbage'}), 1)
+
+    def test_asgi_read_your_writes(self):
+        async def names():
+            app = AsyncApp(self.app)
+            try:
+                _, body, _ = await app.get_actors(EnvironBuilder('/actors').get_request(Request))
+                return [a['name'] for a in json.loads(body)['actors']]
+            finally:
+                for engine in app.engines:
+                    await engine.dispose()
+        with mock.patch.object(AsyncApp, 'authenticate', mock.AsyncMock(return_value={'sub': 'writer'})):
+            self.assertEqual(asyncio.run(names()), ['On replica'])
+            recent_writers.set('writer', True)
+            self.assertEqual(asyncio.run(names()), [])
+
+    def test_cache_filled_from_primary_only(self):
+        setup_cache(size=10)
+        try:
+            with self.app.test_request_context('/actors/1'):
+                self.assertEqual(Actor.get_formatted(1)[0]['name'], 'On replica')
+                db.session.remove()
+            self.assertEqual(len(resource_cache.backend), 0)
+            with self.app.test_request_context('/actors', method='POST'):
+                pk = Actor(name='On primary', age=2, gender=1).insert().id
+                db.session.remove()
+            with self.app.test_request_context(f'/actors/{pk}'):
+                self.assertEqual(Actor.get_formatted(pk)[0]['name'], 'On primary')
+                db.session.remove()
+            self.assertEqual(len(resource_cache.backend), 1)
+        finally:
+            setup_cache(size=0)
+
+    def test_asgi_cache_filled_from_primary_only(self):
+        async def get(pk):
+            app = AsyncApp(self.app)
+            try:
+                return await app.get_actor(EnvironBuilder(f'/actors/{pk}').get_request(Request), pk)
+            finally:
+                for engine in app.engines:
+                    await engine.dispose()
+        setup_cache(size=10)
+        try:
+            with mock.patch.object(AsyncApp, 'authenticate', mock.AsyncMock(return_value={'sub': 'writer'})):
+                self.assertEqual(asyncio.run(get(1))[0], 200)
+                self.assertEqual(len(resource_cache.backend), 0)
+                recent_writers.set('writer', True)
+                with self.assertRaises(NotFound):
+                    asyncio.run(get(1))
+                with self.app.app_context():
+                    db.engine.execute(Actor.__table__.insert(), name='On primary', age=2, gender=1)
+                self.assertEqual(asyncio.run(get(1))[0], 200)
+                self.assertEqual(len(resource_cache.backend), 1)
+        finally:
+            setup_cache(size=0)
+
+    def test_forked_child_disposes_inherited_connections(self):
+        self.count('GET')
+        engine = db.get_engine(self.app, 'replica0')
+        pool = engine.pool
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if engine.pool is not pool else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        # the parent keeps its pool
+        self.assertIs(engine.pool, pool)
+
+
+class SqliteSearchTest(unittest.TestCase):
+    """Search on the FTS5 tables of a sqlite file"""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.app = create_app()
+        setup_db(self.app, f'sqlite:///{self.dir.name}/search.db')
+        with self.app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        if MyTestCase.app is not None:
+            db.app = MyTestCase.app
+        self.dir.cleanup()
+
+    def search(self, *terms, kinds=('actor', 'movie')):
+        with self.app.test_request_context('/search'):
+            results, _ = search_page(terms, kinds)
+            db.session.remove()
+            return [(r['type'], r.get('name') or r.get('title')) for r in results]
+
+    def test_search(self):
+        with self.app.app_context():
+            Actor(name='Tom Hanks', age=64, gender=0).insert()
+            Movie(title='Tomb Raider', release_date=date(2001, 6, 15)).insert()
+            db.session.remove()
+        self.assertEqual(sorted(self.search('tom')), [('actor', 'Tom Hanks'), ('movie', 'Tomb Raider')])
+        self.assertEqual(self.search('tom', kinds=['movie']), [('movie', 'Tomb Raider')])
+        self.assertEqual(self.search('tom', 'cruise'), [])
+
+    def test_index_follows_changes(self):
+        with self.app.app_context():
+            actor = Actor(name='Tom Hanks', age=64, gender=0).insert()
+            actor.name = 'Forrest Gump'
+            actor.update()
+            db.session.remove()
+        self.assertEqual(self.search('tom'), [])
+        self.assertEqual(self.search('forrest'), [('actor', 'Forrest Gump')])
+        with self.app.app_context():
+            Actor.query.one().delete()
+            db.session.remove()
+        self.assertEqual(self.search('forrest'), [])
+
+
+class GroupCommitTest(unittest.TestCase):
+    """Group commit of concurrent inserts into a sqlite file"""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.app = create_app()
+        setup_db(self.app, f'sqlite:///{self.dir.name}/group.db')
+        # a window long enough for all the inserts of a test to make one batch
+        setup_group_commit(self.app, db, enabled=True, window=0.2, max_batch=5)
+        with self.app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        setup_group_commit(self.app, db, enabled=False)
+        if MyTestCase.app is not None:
+            db.app = MyTestCase.app
+        self.dir.cleanup()
+
+    def insert(self, make):
+        with self.app.test_request_context('/actors', method='POST'):
+            try:
+                return make().insert().format()
+            except SQLAlchemyError as e:
+                return e
+            finally:
+                db.session.remove()
+
+    def insert_concurrently(self, *makes):
+        with ThreadPoolExecutor(len(makes)) as pool:
+            return list(pool.map(self.insert, makes))
+
+    def test_inserts_share_a_commit(self):
+        results = self.insert_concurrently(*(
+            lambda i=i: Actor(name=f'Actor {i}', age=30 + i, gender=i % 2) for i in range(4)
+        ))
+        self.assertEqual(sorted(r['name'] for r in results), [f'Actor {i}' for i in range(4)])
+        self.assertEqual(len({r['id'] for r in results}), 4)
+        self.assertEqual(group_committer.batches.count, 1)
+        with self.app.app_context():
+            self.assertEqual({a.id: a.name for a in Actor.query}, {r['id']: r['name'] for r in results})
+            db.session.remove()
+
+    def test_max_batch(self):
+        self.insert_concurrently(*(lambda i=i: Actor(name=f'Actor {i}', age=1, gender=0) for i in range(7)))
+        self.assertEqual(group_committer.batches.count, 2)
+
+    def test_failed_insert_fails_alone(self):
+        existing = self.insert(lambda: Actor(name='Existing', age=1, gender=0))
+        def duplicate():
+            actor = Actor(name='Duplicate', age=2, gender=0)
+            actor.id = existing['id']
+            return actor
+        results = self.insert_concurrently(
+            lambda: Movie(title='Movie', release_date=date(2001, 1, 1)), duplicate,
+            lambda: Actor(name='New', age=3, gender=1),
+        )
+        self.assertEqual(results[0]['title'], 'Movie')
+        self.assertIsInstance(results[1], SQLAlchemyError)
+        self.assertEqual(results[2]['name'], 'New')
+        self.assertEqual(group_committer.retries, 1)
+        with self.app.app_context():
+            self.assertEqual(sorted(a.name for a in Actor.query), ['Existing', 'New'])
+            self.assertEqual(Movie.query.count(), 1)
+            db.session.remove()
+
+    def test_failed_batch_fails_every_insert(self):
+        group_committer.app = None
+        futures = [Future(), Future()]
+        group_committer.write([(Actor, {'name': 'Lost', 'age': 1, 'gender': 0}, future) for future in futures])
+        for future in futures:
+            self.assertIsInstance(future.exception(timeout=0), AttributeError)
+
 
 if __name__ == '__main__':
     unittest.main()